@@ -1,10 +1,11 @@
-import utils
-import os, time, json, sys, dotenv, datetime, shutil, webbrowser
+import utils, data, generation, headless, imaging, catalog, thumbnails, jobqueue
+import os, time, json, sys, sqlite3, dotenv, shutil, webbrowser, multiprocessing
 from rich.console import Console
 from rich.table import Table
 
 console = Console()
 loaded_config = new_data = None
+VIEW_PAGE_SIZE = 15
 
 def initialise_data():
     env_path = utils.DATA_FOLDER+"/.env"
@@ -45,6 +46,8 @@ def initialise_data():
         
         loaded_config, changed = utils.clean_config_file(console, verbose=True)
 
+        catalog.start_reconcile()
+
         if os.path.exists(env_path):
             with open(env_path, 'r') as f: pass
         else:
@@ -195,10 +198,11 @@ def verify_key(key, can_quit=False):
         utils.clear_console(console=console)
         utils.print(f"[bold]Currently asking for:[/bold] {alias} API key.", console=console)
         utils.print(f"[bold]Description:[/bold] {description}", highlight=False, console=console)
+        utils.print("Several keys can be entered separated by commas, requests are then spread across them.", highlight=False, console=console)
         if can_quit: api_key = utils.prompt_input(f"Enter your {alias} API key (enter back to go back)").strip()
         else: api_key = utils.prompt_input(f"Enter your {alias} API key").strip()
         if can_quit and api_key == "back": return
-        if len(api_key) < 3:
+        if min([len(value) for value in data.split_api_keys(api_key)] or [0]) < 3:
             utils.print("API keys must be a minimum of length 3!", level='error', console=console)
             time.sleep(2)
             verify_key(key, can_quit)
@@ -213,7 +217,8 @@ def verify_key(key, can_quit=False):
         if verify:
             utils.clear_console(console=console)
             with console.status(f"[bold green] Verifying {alias} API key...", spinner="point"):
-                response = utils.SERVICES[key]['verification_function'](api_key)
+                responses = [utils.SERVICES[key]['verification_function'](value) for value in data.split_api_keys(api_key)]
+                response = "invalid" if "invalid" in responses else "network" if "network" in responses else "valid"
                 if response == "invalid":
                     utils.debug(f"Oops! The entered {alias} API key was invalid!", level='error', console=console)
                     utils.debug("[bold] Try again!", console=console)
@@ -228,6 +233,7 @@ def verify_key(key, can_quit=False):
             utils.clear_console(console=console)
             with console.status(f"[bold green] Continuing without verifying {alias} API key...", spinner="point"): time.sleep(2)
     try:
+        api_key = ",".join(data.split_api_keys(api_key))
         utils.SERVICES[key]['api_key'] = api_key
         utils.edit_or_add_env_value(key, api_key)
     except:
@@ -361,88 +367,48 @@ def settings_menu():
     if choice == 'back': return
     settings_menu()
 
-def generate_images(model, prompt, amount, additional_parameters, folder_name, timestamp):
+def generate_images(job, resume=False):
     utils.clear_console(console=console)
     
-    batches = [loaded_config['BATCH_SIZE']['value']] * (amount // loaded_config['BATCH_SIZE']['value'])
-    if amount % loaded_config['BATCH_SIZE']['value'] != 0: batches.append(amount % loaded_config['BATCH_SIZE']['value'])
-    
-    os.makedirs(f"{utils.GENERATIONS_FOLDER}/{folder_name}")
-    with open(f"{utils.GENERATIONS_FOLDER}/{folder_name}/settings.txt", 'w') as f:
-        settings_message = f"Generation Settings\n\nPrompt: {prompt}\nTimestamp: {timestamp}\nModel: {model['alias']}\nImage Amount: {amount}"
-        for parameter in additional_parameters.values():
-            settings_message += f"\n{parameter['alias']}: {parameter['value']}" 
-        f.write(settings_message)
-    
     crtical_error_faced = False
     critical_error_desc = None
-    image_count = 0
-    batches_completed = 0
         
-    with console.status(f"[bold green] Generating {amount} image(s) in {len(batches)} batch(es)...", spinner="arc"):
-        for result in model['generate_function'](prompt, batches, additional_parameters):
+    with console.status(f"[bold green] Generating {generation.get_image_total(job)} image(s)...", spinner="arc"):
+        for result in generation.generate(job, loaded_config, resume):
             if result['type'] == "log": 
-                utils.clear_console(console=console)
-                time.sleep(1)
-                utils.debug(result['message'], highlight = False, console=console)
+                if not result['level']:
+                    utils.clear_console(console=console)
+                    time.sleep(1)
+                    utils.debug(result['message'], highlight = False, console=console)
+                else: utils.debug(result['message'], level=result['level'], highlight = False, console=console)
+            elif result['type'] == "image": utils.debug(result['message'], level="success", highlight = False, console=console)
             elif result['type'] == "error":
                 if result['level'] == "critical":
                     crtical_error_faced = True
                     critical_error_desc = result['message']
                 else:
-                    utils.debug("[bold]Handled error faced! Skipping to next batch...[/bold]", level="error", console=console)
+                    utils.debug("[bold]Handled error faced![/bold]", level="error", console=console)
                     utils.debug(f"Developer Info: {result['message']}", level="debug", highlight = False, console=console)
-                    time.sleep(4)
-            elif result['type'] == "b64_json" or result['type'] == "url":
-                utils.debug(result['message'], highlight = False, console=console)
-                time.sleep(1)
-                images = result['value']
-                utils.debug(f"Saving {len(images)} image(s)...", highlight = False, console=console)
-                time.sleep(2)
-                
-                images_saved = 0
-                for image in images:
-                    image_count += 1
-                    if result['type'] == "b64_json":
-                        try: utils.base64_json_to_image(image, f"{utils.GENERATIONS_FOLDER}/{folder_name}/{image_count}.png")
-                        except: 
-                            utils.debug(f"Failed to save image {image_count}! Continuing...", highlight = False, level="warning", console=console)
-                            time.sleep(2)
-                        else: images_saved += 1
-                    elif result['type'] == "url":
-                        try: utils.url_to_image(image, f"{utils.GENERATIONS_FOLDER}/{folder_name}/{image_count}.png")
-                        except: 
-                            utils.debug(f"Failed to save image {image_count}! Continuing...", highlight = False, level="warning", console=console)
-                            time.sleep(2)
-                        else: images_saved += 1
-                        
-                if images_saved == 0: utils.debug("Failed to save all images! Continuing...", highlight = False, level="warning", console=console)
-                else: utils.debug(f"Saved {images_saved} image(s) out of {len(images)}!", highlight = False, level="success", console=console)
-                time.sleep(2)
-                
-                batches_completed += 1
-                if batches_completed != len(batches):  
-                    utils.clear_console(console=console)
-                    utils.debug(f"Waiting {loaded_config['BATCH_TIMEOUT']['value']} second(s) before continuing to the next batch to avoid rate limits.", highlight = False, level="debug", console=console)
-                    utils.debug("This value can be changed in the 'settings/config' menu.", console=console)
-                    time.sleep(loaded_config['BATCH_TIMEOUT']['value'])
-        
-            if crtical_error_faced: break
+        time.sleep(2)
         
     utils.clear_console(console=console)
         
     if crtical_error_faced:
         utils.print("[bold]Critical Error Occured![/bold]", level="error")
         utils.print(f"Description: {critical_error_desc}", level="debug", highlight=False)
-        if utils.confirm_input("\nWould you like to delete the generation folder?"):
+        if os.path.exists(f"{utils.GENERATIONS_FOLDER}/{job['title']}"): utils.print("Images saved so far are kept, and the generation can be resumed later from the view menu.")
+        if os.path.exists(f"{utils.GENERATIONS_FOLDER}/{job['title']}") and utils.confirm_input("\nWould you like to delete the generation folder?"):
             utils.clear_console(console=console)
             with console.status("[bold green] Deleting generation folder...", spinner="arc"): time.sleep(1)
-            try: shutil.rmtree(f"{utils.GENERATIONS_FOLDER}/{folder_name}")
+            try: shutil.rmtree(f"{utils.GENERATIONS_FOLDER}/{job['title']}")
             except: pass
-        return
+            try: catalog.remove_generation(job['title'])
+            except: pass
+        return False
 
     utils.print("[bold]Generation finished successfully![/bold]", level="success")
     utils.prompt_input("Press enter to continue")
+    return True
 
 def generate_model(model):
     utils.clear_console(console=console, check_online=model['online_only'], show_reconnect_info=1)
@@ -482,7 +448,7 @@ def generate_model(model):
     utils.clear_console(console=console)
     utils.print("[bold]Base Parameters for Image Generation[/bold]", console=console)
     title = utils.prompt_input("Enter a title for this generation (leave blank for timestamp or enter back to go back)").strip()
-    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H-%M-%S')
+    timestamp = generation.get_timestamp()
     if title == "back": return
     if title == "": title = timestamp
     if len(title) < 3:
@@ -495,7 +461,7 @@ def generate_model(model):
         time.sleep(2)
         generate_model(model)
         return
-    if os.path.exists(f"{utils.GENERATIONS_FOLDER}/{title}"):
+    if os.path.exists(f"{utils.GENERATIONS_FOLDER}/{title}") or jobqueue.title_taken(title):
         utils.print("Generation folder with the same title already exists!", level='error', console=console)
         time.sleep(2)
         generate_model(model)
@@ -509,7 +475,7 @@ def generate_model(model):
     else: os.rmdir(f"{utils.GENERATIONS_FOLDER}/{title}")
     utils.clear_console(console=console)
     with console.status(f"[bold green] Loading {model['alias']} additional parameters...", spinner="point"): time.sleep(2)
-    additional_parameters = {}
+    chosen_parameters = {}
     if not parameters: 
         with console.status(f"[bold green] No additional parameters found. Continuing...", spinner="point"): time.sleep(2)
     else:
@@ -520,10 +486,31 @@ def generate_model(model):
             utils.print(f"[bold]Default option:[/bold] {parameter['default']}")
             choice = utils.prompt_input(f"Enter your option for this parameter", choices=parameter['options'] + ['back'])
             if choice == "back": return
-            additional_parameters[parameter['name']] = {"alias": parameter['alias'], "value": choice}
+            chosen_parameters[parameter['name']] = choice
         utils.clear_console(console=console)
         with console.status(f"[bold green] Additional parameters applied. Continuing...", spinner="point"): time.sleep(2)
-    generate_images(model, prompt, image_amount, additional_parameters, title, timestamp)
+    utils.clear_console(console=console)
+    utils.print(f"[bold]Currently asking for:[/bold] Output Format", console=console)
+    utils.print(f"[bold]Description:[/bold] The file format of the saved image(s). Formats {model['alias']} can't return are converted after saving.", console=console)
+    utils.print(f"[bold]Default option:[/bold] png")
+    output_format = utils.prompt_input(f"Enter your option for the output format", choices=imaging.OUTPUT_FORMATS + ['back'])
+    if output_format == "back": return
+    job = {"model": model['name'], "prompt": prompt, "amount": image_amount, "parameters": chosen_parameters, "title": title, "timestamp": timestamp, "output_format": output_format}
+    queue_job(job)
+
+def queue_job(job):
+    # Jobs always go through the queue; with no worker running, this window leases and runs the job itself
+    job_id = jobqueue.enqueue(job)
+    worker_id = jobqueue.get_worker_id()
+    claimed = None if jobqueue.workers_active(worker_id) else jobqueue.claim(worker_id, job_id)
+    if not claimed:
+        utils.clear_console(console=console)
+        utils.print("[bold]Generation queued![/bold] A running worker will pick it up.", level="success")
+        utils.prompt_input("Press enter to continue")
+        return
+    with jobqueue.LeaseKeeper(job_id, worker_id, is_worker=False): finished = generate_images(job)
+    images_saved = generation.count_saved_images(job['title']) or 0
+    jobqueue.complete(job_id, worker_id, images_saved, None if finished and images_saved >= job['amount'] else f"Saved {images_saved} image(s) out of {job['amount']}.")
 
 def generate_service(service_key):
     utils.clear_console(console=console)
@@ -584,8 +571,13 @@ def view_folder(folder_name):
         utils.print(f"Folder '{folder_name}' missing! Returning.", level="error")
         time.sleep(2)
         return
-    images = [image for image in filter(utils.valid_generation_image, os.listdir(f"{utils.GENERATIONS_FOLDER}/{folder_name}"))]
-    if len(images) == 0:
+    catalog.reconcile_folder(folder_name)
+    generation_record = catalog.get_generation(folder_name)
+    image_count = generation_record['image_count'] if generation_record else 0
+    # Not offered while a worker holds the generation's lease, resuming it alongside would put two writers in one folder
+    try: resume_job = None if jobqueue.title_leased(folder_name) else generation.load_resume_job(folder_name)
+    except (OSError, ValueError, sqlite3.Error): resume_job = None
+    if image_count == 0 and not resume_job:
         utils.print("[bold]No images found![/bold]", level="error")
         delete = utils.confirm_input("Would you like to delete this generation folder?")
         if delete:
@@ -593,19 +585,33 @@ def view_folder(folder_name):
             with console.status("[bold green] Deleting generation folder...", spinner="arc"): time.sleep(2)
             try: shutil.rmtree(f"{utils.GENERATIONS_FOLDER}/{folder_name}")
             except: pass
+            catalog.remove_generation(folder_name)
             return
         else: return
     else:
-        utils.print(f"[bold]Generation '{folder_name}':[/bold] {len(images)} Image(s) found!", highlight=False)
+        utils.print(f"[bold]Generation '{folder_name}':[/bold] {image_count} Image(s) found!", highlight=False)
     settings_exists = os.path.exists(f"{utils.GENERATIONS_FOLDER}/{folder_name}/settings.txt")
-    choices = ["open","rename","delete","back"]
+    choices = ["preview","open","rename","delete","back"]
+    if resume_job:
+        utils.print(f"Generation was interrupted before saving all {generation.get_image_total(resume_job)} image(s).", level="warning")
+        choices.insert(0, "resume")
     if not settings_exists: utils.print("Settings file not found!", level="warning")
     else: choices.insert(1, "settings")
     selection = utils.prompt_input(f"What would you like to do with the generation folder?", choices=choices)
-    if selection == "open": webbrowser.open(f'file:///{utils.GENERATIONS_FOLDER}/{folder_name}', new=1, autoraise=True)
+    if selection == "resume":
+        generate_images(resume_job, resume=True)
+        catalog.reconcile_folder(folder_name)
+    elif selection == "preview":
+        with console.status("[bold green] Preparing contact sheet...", spinner="arc"):
+            try: sheet_path = thumbnails.get_contact_sheet(folder_name)
+            except Exception: sheet_path = None
+        if sheet_path: webbrowser.open(f'file:///{sheet_path}', new=1, autoraise=True)
+        else:
+            utils.print("Failed to prepare a contact sheet for this generation.", level='error', console=console)
+            time.sleep(2)
+    elif selection == "open": webbrowser.open(f'file:///{utils.GENERATIONS_FOLDER}/{folder_name}', new=1, autoraise=True)
     elif selection == "rename":
         utils.clear_console(console=console)
-        folders = [folder for folder in filter(lambda x: x.count('.') == 0, os.listdir(utils.GENERATIONS_FOLDER))]
         new_name = utils.prompt_input("Enter the new title for this generation")
         if len(new_name) < 3:
             utils.print("Title must have a length of at least 3.", level='error', console=console)
@@ -613,7 +619,7 @@ def view_folder(folder_name):
         elif new_name == folder_name:
             utils.print("Title already used by this generation.", level='error', console=console)
             time.sleep(2)
-        elif new_name in folders:
+        elif os.path.exists(f"{utils.GENERATIONS_FOLDER}/{new_name}"):
             utils.print("Title used in another generation.", level='error', console=console)
             time.sleep(2)
         else:
@@ -622,6 +628,7 @@ def view_folder(folder_name):
                 utils.print("Failed to rename generation.", level='error', console=console)
                 time.sleep(2)
             else:
+                catalog.rename_generation(folder_name, new_name)
                 utils.print("[bold]Successfully renamed generation![/bold]", level='success', console=console)
                 time.sleep(2)
                 folder_name = new_name 
@@ -634,31 +641,59 @@ def view_folder(folder_name):
             with console.status("[bold green] Deleting generation folder...", spinner="arc"): time.sleep(1)
             try: shutil.rmtree(f"{utils.GENERATIONS_FOLDER}/{folder_name}")
             except: pass
+            catalog.remove_generation(folder_name)
             return
     elif selection == "back": return
     view_folder(folder_name)
 
-def view_menu():
+def view_menu(page=0, order="newest", model=None, query=None):
+    # Listing comes from the catalog, so each page costs one indexed query however many generations there are
     utils.clear_console(console=console)
     if not os.path.exists(utils.GENERATIONS_FOLDER):
         with console.status("[bold green] Generations folder missing. Creating new generations folder...", spinner="arc"): time.sleep(2)
         os.mkdir(utils.GENERATIONS_FOLDER)
-    table = Table(title="Available Generations", title_justify="left")
-    table.add_column("No.", justify="right", style="cyan")
-    table.add_column("Name", style="magenta")
-    folders = [folder for folder in filter(lambda x: x.count('.') == 0, os.listdir(utils.GENERATIONS_FOLDER))]
-    if len(folders) == 0:
+    total = catalog.count_generations(model, query)
+    if total == 0 and not model and query is None and not catalog.is_reconciling():
         utils.print("[bold]No Generations found![/bold]")
         utils.prompt_input("Press enter to continue")
         return
-    for i, folder in enumerate(folders):
-        table.add_row(str(i+1), folder)
+    page_count = max(1, -(-total // VIEW_PAGE_SIZE))
+    page = min(page, page_count - 1)
+    generations = catalog.list_generations(page * VIEW_PAGE_SIZE, VIEW_PAGE_SIZE, order, model, query)
+    listing = f"matching '{query}'" if query is not None else f"{order} first"
+    table = Table(title=f"Available Generations (page {page+1}/{page_count}, {listing}{f', {model} only' if model else ''})", title_justify="left")
+    table.add_column("No.", justify="right", style="cyan")
+    table.add_column("Name", style="magenta")
+    table.add_column("Model")
+    table.add_column("Images", justify="right")
+    table.add_column("Timestamp", style="green")
+    for i, generation_record in enumerate(generations):
+        table.add_row(str(i+1), generation_record['title'], generation_record['model'] or "Unknown", str(generation_record['image_count']), generation_record['timestamp'] or "")
     utils.print(table, console=console)
-    selection = utils.prompt_input("Enter a number for the generation you would like to view", choices=["open"] + [str(x+1) for x in range(len(folders))] + ["back"])
+    if catalog.is_reconciling(): utils.print("Still indexing existing generations, some may not be listed yet.", level="warning", console=console)
+    choices = ["open"] + [str(x+1) for x in range(len(generations))]
+    if page > 0: choices.append("prev")
+    if page < page_count - 1: choices.append("next")
+    choices += ["search", "sort", "filter", "back"]
+    selection = utils.prompt_input("Enter a number for the generation you would like to view", choices=choices)
     if selection == "open": webbrowser.open(f"file:///{utils.GENERATIONS_FOLDER}", new=1, autoraise=True)
     elif selection == "back": return
-    else: view_folder(folders[int(selection)-1])
-    view_menu()
+    elif selection == "prev": page -= 1
+    elif selection == "next": page += 1
+    elif selection == "search":
+        query = utils.prompt_input("Enter words to search prompts, titles and parameters for (leave blank to list all)").strip() or None
+        page = 0
+    elif selection == "sort":
+        order = utils.prompt_input("Choose how to sort generations", choices=list(catalog.ORDERS.keys()))
+        query = None
+        page = 0
+    elif selection == "filter":
+        models = [model['name'] for service in utils.SERVICES.values() for model in service['models']]
+        model = utils.prompt_input("Choose a model to filter by", choices=["all"] + models)
+        if model == "all": model = None
+        page = 0
+    else: view_folder(generations[int(selection)-1]['title'])
+    view_menu(page, order, model, query)
 
 def home(attempt_reconnect=True):
     utils.clear_console(console=console, check_online=attempt_reconnect, show_reconnect_info=2)
@@ -708,5 +743,10 @@ def main():
     utils.clear_console(header=False)
     sys.exit()
 
-try: main()
-except Exception as e: critical_error(str(e))
\ No newline at end of file
+# Guarded so process pool workers (which re-import this module on Windows) don't launch the app
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1: sys.exit(headless.main(sys.argv[1:]))
+
+    try: main()
+    except Exception as e: critical_error(str(e))
\ No newline at end of file
@@ -0,0 +1,126 @@
+import utils
+import os, json, hashlib, shutil, tempfile, threading, time
+
+CACHE_FOLDER = f"{utils.DATA_FOLDER}/Cache"
+STATS_FILE = f"{CACHE_FOLDER}/stats.json"
+
+stats_lock = threading.Lock()
+
+def get_cache_key(job, output_format):
+    # Whitespace in the prompt is normalised so trivially different prompts still share variants
+    request = {
+        "model": job['model'],
+        "prompt": " ".join(job['prompt'].split()),
+        "parameters": job['parameters'],
+        "output_format": output_format
+    }
+    if job.get('seed') is not None: request['seed'] = job['seed']
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_entry_folder(cache_key):
+    return f"{CACHE_FOLDER}/{cache_key[:2]}/{cache_key}"
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""): digest.update(chunk)
+    return digest.hexdigest()
+
+def link_or_copy(source_path, destination_path):
+    # Hardlinks cost no extra disk space; every image is written through an atomic rename so the shared inode never changes underneath
+    folder_path, file_name = os.path.split(destination_path)
+    temp_path = f"{folder_path}/.{file_name}.{os.getpid()}.{threading.get_ident()}.part"
+    try: os.link(source_path, temp_path)
+    except OSError: shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, destination_path)
+
+def get_marker_path(variant_path):
+    folder_path, file_name = os.path.split(variant_path)
+    return f"{folder_path}/.{file_name}.used"
+
+def mark_used(variant_path):
+    # Recency is kept on a marker of the cache's own, the variant may share its inode (and so its mtime) with a generation's image
+    marker_path = get_marker_path(variant_path)
+    try:
+        with open(marker_path, 'a'): pass
+        os.utime(marker_path)
+    except OSError: pass
+
+def get_stats():
+    with stats_lock:
+        try:
+            with open(STATS_FILE, 'r') as f: return json.load(f)
+        except (OSError, ValueError): return {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+
+def record_stats(**counts):
+    with stats_lock:
+        try:
+            with open(STATS_FILE, 'r') as f: stats = json.load(f)
+        except (OSError, ValueError): stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+        for key, count in counts.items(): stats[key] = stats.get(key, 0) + count
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(suffix=".part", dir=CACHE_FOLDER)
+        with os.fdopen(file_descriptor, 'w') as f: json.dump(stats, f)
+        os.replace(temp_path, STATS_FILE)
+
+def lookup(cache_key, amount):
+    # Returns up to `amount` cached variants and marks them as recently used
+    entry_folder = get_entry_folder(cache_key)
+    try: variants = sorted(entry.path for entry in os.scandir(entry_folder) if entry.is_file() and not entry.name.startswith("."))
+    except FileNotFoundError: variants = []
+    variants = variants[:amount]
+    for variant_path in variants: mark_used(variant_path)
+    record_stats(hits=len(variants), misses=amount - len(variants))
+    return variants
+
+def restore(variant_path, output_file_path):
+    link_or_copy(variant_path, output_file_path)
+
+def store(cache_key, image_path, file_hash=None):
+    entry_folder = get_entry_folder(cache_key)
+    os.makedirs(entry_folder, exist_ok=True)
+    variant_path = f"{entry_folder}/{file_hash or hash_file(image_path)}{os.path.splitext(image_path)[1]}"
+    if os.path.exists(variant_path):
+        mark_used(variant_path)
+        return variant_path
+    link_or_copy(image_path, variant_path)
+    mark_used(variant_path)
+    record_stats(stored=1)
+    return variant_path
+
+def evict(max_size_bytes, max_age_seconds):
+    # Least recently used variants go first, anything unused for longer than max_age_seconds always goes
+    # Only variants no generation links to count toward max_size_bytes, removing a shared one frees no disk space
+    if not os.path.exists(CACHE_FOLDER): return 0
+    variants = []
+    for prefix in os.scandir(CACHE_FOLDER):
+        if not prefix.is_dir(): continue
+        for entry in os.scandir(prefix.path):
+            if not entry.is_dir(): continue
+            for variant in os.scandir(entry.path):
+                if not variant.is_file() or variant.name.startswith("."): continue
+                # os.stat rather than the entry's own stat, which leaves st_nlink at 0 on Windows
+                try: variant_stat = os.stat(variant.path)
+                except OSError: continue
+                try: last_used = os.stat(get_marker_path(variant.path)).st_mtime
+                except OSError: last_used = variant_stat.st_mtime
+                variants.append((last_used, variant_stat.st_size, variant_stat.st_nlink > 1, variant.path))
+    variants.sort()
+
+    now = time.time()
+    total_size = sum(size for last_used, size, shared, path in variants if not shared)
+    evicted = 0
+    for last_used, size, shared, path in variants:
+        if now - last_used <= max_age_seconds:
+            if total_size <= max_size_bytes: break
+            if shared: continue
+        try: os.remove(path)
+        except OSError: continue
+        try: os.remove(get_marker_path(path))
+        except OSError: pass
+        if not shared: total_size -= size
+        evicted += 1
+        try: os.rmdir(os.path.dirname(path))
+        except OSError: pass
+    if evicted: record_stats(evicted=evicted)
+    return evicted
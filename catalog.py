@@ -0,0 +1,267 @@
+import utils, data, cache, imaging
+import os, json, sqlite3, threading, datetime
+
+CATALOG_FILE = f"{utils.DATA_FOLDER}/catalog.db"
+ORDERS = {
+    "newest": "timestamp DESC, title",
+    "oldest": "timestamp ASC, title",
+    "title": "title COLLATE NOCASE",
+    "images": "image_count DESC, timestamp DESC"
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL UNIQUE,
+    prompt TEXT,
+    model TEXT,
+    parameters TEXT,
+    timestamp TEXT,
+    image_amount INTEGER,
+    output_format TEXT,
+    image_count INTEGER NOT NULL DEFAULT 0,
+    folder_mtime REAL
+);
+CREATE INDEX IF NOT EXISTS generations_timestamp ON generations (timestamp);
+CREATE INDEX IF NOT EXISTS generations_model ON generations (model, timestamp);
+CREATE TABLE IF NOT EXISTS images (
+    generation_id INTEGER NOT NULL REFERENCES generations (id) ON DELETE CASCADE,
+    file_name TEXT NOT NULL,
+    size INTEGER,
+    hash TEXT,
+    mtime REAL,
+    phash INTEGER,
+    PRIMARY KEY (generation_id, file_name)
+);
+CREATE INDEX IF NOT EXISTS images_hash ON images (hash);
+"""
+
+# Parameters are indexed by value only, the JSON keys would otherwise match every generation of a model
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS generations_search USING fts5 (title, prompt, parameters);
+CREATE TRIGGER IF NOT EXISTS generations_search_insert AFTER INSERT ON generations BEGIN
+    INSERT INTO generations_search (rowid, title, prompt, parameters) VALUES (new.id, new.title, new.prompt, (SELECT group_concat(value, ' ') FROM json_each(new.parameters)));
+END;
+CREATE TRIGGER IF NOT EXISTS generations_search_delete AFTER DELETE ON generations BEGIN
+    DELETE FROM generations_search WHERE rowid = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS generations_search_update AFTER UPDATE OF title, prompt, parameters ON generations BEGIN
+    DELETE FROM generations_search WHERE rowid = old.id;
+    INSERT INTO generations_search (rowid, title, prompt, parameters) VALUES (new.id, new.title, new.prompt, (SELECT group_concat(value, ' ') FROM json_each(new.parameters)));
+END;
+"""
+
+connections = threading.local()
+reconcile_thread = None
+
+def connect():
+    # One connection per thread; WAL lets the menus read while a generation is writing
+    connection = getattr(connections, "connection", None)
+    if connection is None:
+        os.makedirs(utils.DATA_FOLDER, exist_ok=True)
+        connection = sqlite3.connect(CATALOG_FILE, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        connection.executescript(SCHEMA)
+        if "phash" not in [column['name'] for column in connection.execute("PRAGMA table_info(images)")]:
+            connection.execute("ALTER TABLE images ADD COLUMN phash INTEGER")
+        # Catalogs created before search existed get their index filled once, later rows arrive through the triggers
+        with connection:
+            search_missing = not connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'generations_search'").fetchone()
+            connection.executescript(SEARCH_SCHEMA)
+            if search_missing: connection.execute("INSERT INTO generations_search (rowid, title, prompt, parameters) SELECT id, title, prompt, (SELECT group_concat(value, ' ') FROM json_each(parameters)) FROM generations")
+        connections.connection = connection
+    return connection
+
+def get_folder_path(title):
+    return f"{utils.GENERATIONS_FOLDER}/{title}"
+
+def get_file_name(title, image_path):
+    # Images in the model subfolders of a comparison are recorded as "subfolder/file"
+    return os.path.relpath(image_path, get_folder_path(title)).replace(os.sep, "/")
+
+def get_image_entries(title):
+    # Returns (file name, os.DirEntry) for every image of a generation, descending into subfolders only where they exist
+    image_entries = []
+    for entry in os.scandir(get_folder_path(title)):
+        if entry.name.startswith("."): continue
+        if entry.is_file() and utils.valid_generation_image(entry.name): image_entries.append((entry.name, entry))
+        elif entry.is_dir():
+            image_entries += [(f"{entry.name}/{sub_entry.name}", sub_entry) for sub_entry in os.scandir(entry.path) if sub_entry.is_file() and utils.valid_generation_image(sub_entry.name) and not sub_entry.name.startswith(".")]
+    return image_entries
+
+def get_folder_mtime(title):
+    try: return os.stat(get_folder_path(title)).st_mtime
+    except OSError: return None
+
+def read_settings_file(title):
+    # Recovers what it can for generations the catalog has never seen: settings.json, then settings.txt, then an image's PNG text
+    record = {"prompt": None, "model": None, "parameters": {}, "timestamp": None, "image_amount": None, "output_format": None}
+    try:
+        with open(f"{get_folder_path(title)}/settings.json", 'r', encoding='utf-8') as f: metadata = json.load(f)
+        record.update(prompt=metadata['prompt'], model=metadata['model'], parameters=metadata['parameters'], timestamp=metadata['timestamp'], image_amount=metadata['amount'], output_format=metadata['output_format'])
+        return record
+    except (OSError, ValueError, KeyError, TypeError): pass
+    if not os.path.exists(f"{get_folder_path(title)}/settings.txt"):
+        try:
+            image_name = next(name for name in sorted(os.listdir(get_folder_path(title))) if name.endswith(".png"))
+            metadata = json.loads(imaging.read_png_text(f"{get_folder_path(title)}/{image_name}")['ImagineSuite'])
+            record.update(prompt=metadata['prompt'], model=metadata['model'], parameters=metadata['parameters'])
+        except (OSError, ValueError, KeyError, TypeError, StopIteration): pass
+        return record
+    try:
+        with open(f"{get_folder_path(title)}/settings.txt", 'r') as f: lines = f.read().splitlines()
+    except (OSError, UnicodeDecodeError): return record
+    fields = {}
+    for line in lines[2:]:
+        if ": " in line:
+            alias, value = line.split(": ", 1)
+            fields[alias] = value
+    record['prompt'] = fields.pop("Prompt", None)
+    record['timestamp'] = fields.pop("Timestamp", None)
+    record['output_format'] = fields.pop("Output Format", None)
+    try: record['image_amount'] = int(fields.pop("Image Amount", None))
+    except (TypeError, ValueError): pass
+    model_alias = fields.pop("Model", None)
+    for service in data.SERVICES.values():
+        for model in service['models']:
+            if model['alias'] != model_alias: continue
+            record['model'] = model['name']
+            for parameter in model['additional_parameters'] or []:
+                if parameter['alias'] in fields: record['parameters'][parameter['name']] = fields[parameter['alias']]
+    return record
+
+def add_generation(job):
+    # Replaced by hand rather than with INSERT OR REPLACE, whose implicit delete skips the search triggers
+    connection = connect()
+    with connection:
+        connection.execute("DELETE FROM generations WHERE title = ?", (job['title'],))
+        connection.execute(
+            "INSERT INTO generations (title, prompt, model, parameters, timestamp, image_amount, output_format, image_count, folder_mtime) VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)",
+            (job['title'], job['prompt'], job['model'], json.dumps(job['parameters'], sort_keys=True), job['timestamp'], job['amount'], job.get('output_format', "png"), get_folder_mtime(job['title']))
+        )
+
+def add_image(title, image_path, file_hash=None):
+    # Returns the image's rowid, or None if the generation isn't catalogued
+    stat = os.stat(image_path)
+    file_hash = file_hash or cache.hash_file(image_path)
+    connection = connect()
+    with connection:
+        row = connection.execute("SELECT id FROM generations WHERE title = ?", (title,)).fetchone()
+        if not row: return
+        file_name = get_file_name(title, image_path)
+        # Counted up rather than recounted, which would cost a scan of the generation's images for every image added
+        replaced = connection.execute("SELECT 1 FROM images WHERE generation_id = ? AND file_name = ?", (row['id'], file_name)).fetchone()
+        image_id = connection.execute("INSERT OR REPLACE INTO images (generation_id, file_name, size, hash, mtime) VALUES (?, ?, ?, ?, ?)", (row['id'], file_name, stat.st_size, file_hash, stat.st_mtime)).lastrowid
+        connection.execute("UPDATE generations SET image_count = image_count + ?, folder_mtime = ? WHERE id = ?", (0 if replaced else 1, get_folder_mtime(title), row['id']))
+    return image_id
+
+def rename_generation(title, new_title):
+    connection = connect()
+    with connection:
+        connection.execute("DELETE FROM generations WHERE title = ?", (new_title,))
+        connection.execute("UPDATE generations SET title = ?, folder_mtime = ? WHERE title = ?", (new_title, get_folder_mtime(new_title), title))
+
+def remove_generation(title):
+    connection = connect()
+    with connection: connection.execute("DELETE FROM generations WHERE title = ?", (title,))
+
+def reconcile_folder(title, folder_mtime=None):
+    # Rescans one folder, only hashing images whose size or mtime changed since they were recorded
+    connection = connect()
+    folder_mtime = folder_mtime or get_folder_mtime(title)
+    if folder_mtime is None:
+        remove_generation(title)
+        return
+    row = connection.execute("SELECT id, folder_mtime FROM generations WHERE title = ?", (title,)).fetchone()
+    if row and row['folder_mtime'] == folder_mtime: return
+
+    with connection:
+        if not row:
+            record = read_settings_file(title)
+            timestamp = record['timestamp'] or datetime.datetime.fromtimestamp(folder_mtime).strftime('%Y-%m-%d %H-%M-%S')
+            # OR IGNORE: the background pass and an open view menu can both reach a new folder first
+            connection.execute(
+                "INSERT OR IGNORE INTO generations (title, prompt, model, parameters, timestamp, image_amount, output_format) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (title, record['prompt'], record['model'], json.dumps(record['parameters'], sort_keys=True), timestamp, record['image_amount'], record['output_format'])
+            )
+            generation_id = connection.execute("SELECT id FROM generations WHERE title = ?", (title,)).fetchone()['id']
+        else: generation_id = row['id']
+
+        known_images = {image['file_name']: image for image in connection.execute("SELECT file_name, size, mtime FROM images WHERE generation_id = ?", (generation_id,))}
+        found_images = set()
+        try: entries = get_image_entries(title)
+        except OSError: entries = []
+        for file_name, entry in entries:
+            found_images.add(file_name)
+            stat = entry.stat()
+            known_image = known_images.get(file_name)
+            if known_image and known_image['size'] == stat.st_size and known_image['mtime'] == stat.st_mtime: continue
+            try: file_hash = cache.hash_file(entry.path)
+            except OSError: continue
+            connection.execute("INSERT OR REPLACE INTO images (generation_id, file_name, size, hash, mtime) VALUES (?, ?, ?, ?, ?)", (generation_id, file_name, stat.st_size, file_hash, stat.st_mtime))
+        for file_name in set(known_images) - found_images:
+            connection.execute("DELETE FROM images WHERE generation_id = ? AND file_name = ?", (generation_id, file_name))
+        connection.execute("UPDATE generations SET image_count = ?, folder_mtime = ? WHERE id = ?", (len(found_images), folder_mtime, generation_id))
+
+def reconcile():
+    # Startup pass: one stat per generation folder, only folders whose mtime moved are rescanned
+    if not os.path.exists(utils.GENERATIONS_FOLDER): return
+    connection = connect()
+    known_folders = {row['title']: row['folder_mtime'] for row in connection.execute("SELECT title, folder_mtime FROM generations")}
+    found_folders = set()
+    for entry in os.scandir(utils.GENERATIONS_FOLDER):
+        if not entry.is_dir() or entry.name.count('.') != 0: continue
+        found_folders.add(entry.name)
+        folder_mtime = entry.stat().st_mtime
+        if known_folders.get(entry.name) != folder_mtime: reconcile_folder(entry.name, folder_mtime)
+    missing_folders = set(known_folders) - found_folders
+    if missing_folders:
+        with connection: connection.executemany("DELETE FROM generations WHERE title = ?", [(title,) for title in missing_folders])
+
+def start_reconcile():
+    # Backfills the catalog (and with it the search index) without holding up startup
+    global reconcile_thread
+    def run():
+        try: reconcile()
+        except Exception: pass
+    reconcile_thread = threading.Thread(target=run, name="ImagineSuiteCatalog", daemon=True)
+    reconcile_thread.start()
+
+def is_reconciling():
+    return reconcile_thread is not None and reconcile_thread.is_alive()
+
+def get_match_expression(query):
+    # Every word must match, quoted so user input can't form FTS syntax, and the last one also matches as a prefix
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if terms: terms[-1] += "*"
+    return " ".join(terms)
+
+def get_where_clause(model, query):
+    clauses, arguments = [], ()
+    if query:
+        clauses.append("generations_search MATCH ?")
+        arguments += (get_match_expression(query),)
+    if model:
+        clauses.append("model = ?")
+        arguments += (model,)
+    source = "generations_search JOIN generations ON generations.id = generations_search.rowid" if query else "generations"
+    return source, f"WHERE {' AND '.join(clauses)}" if clauses else "", arguments
+
+def count_generations(model=None, query=None):
+    if query is not None and not query.split(): return 0
+    source, where, arguments = get_where_clause(model, query)
+    return connect().execute(f"SELECT COUNT(*) FROM {source} {where}", arguments).fetchone()[0]
+
+def list_generations(offset=0, limit=20, order="newest", model=None, query=None):
+    # Searches are ranked by bm25 relevance instead of the chosen order
+    if query is not None and not query.split(): return []
+    source, where, arguments = get_where_clause(model, query)
+    order_by = "generations_search.rank" if query else ORDERS[order]
+    rows = connect().execute(f"SELECT generations.* FROM {source} {where} ORDER BY {order_by} LIMIT ? OFFSET ?", arguments + (limit, offset)).fetchall()
+    return [dict(row) for row in rows]
+
+def get_generation(title):
+    row = connect().execute("SELECT * FROM generations WHERE title = ?", (title,)).fetchone()
+    return dict(row) if row else None
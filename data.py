@@ -1,7 +1,29 @@
-import openai, asyncio, requests
+import scheduler, runtime
+import openai, csv, json, math
 
-def run_async_as_sync(async_function):
-    return asyncio.get_event_loop().run_until_complete(async_function)
+class StabilityAIError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(status_code)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+def find_model(model_name):
+    for service_key, service in SERVICES.items():
+        for model in service['models']:
+            if model['name'] == model_name: return service_key, model
+    return None, None
+
+# Options that mean the same thing to different models, so one set of parameters can be mapped onto every model of a comparison
+EQUIVALENT_OPTIONS = {
+    "aspect_ratio": [["square", "1:1"], ["landscape", "16:9"], ["portrait", "9:16"]]
+}
+
+def split_api_keys(api_key):
+    # A service's entry may hold several keys separated by commas, each with its own rate limits
+    return [value.strip() for value in (api_key or "").split(",") if value.strip()]
+
+def get_key_pool(service_key):
+    return scheduler.get_key_pool(service_key, split_api_keys(SERVICES[service_key]['api_key']))
 
 def verify_openai(api_key):
     client = openai.OpenAI(api_key=api_key)
@@ -10,178 +32,180 @@ def verify_openai(api_key):
     except: return "invalid"
     else: return "valid"
 
-def generate_dalle3(prompt, batches, additional_parameters):
-    
-    response_format = "b64_json"
-    
-    client = openai.AsyncOpenAI(api_key=SERVICES["OPENAI"]["api_key"])
-    if additional_parameters['aspect_ratio']['value'] == "square": additional_parameters['aspect_ratio']['value'] = "1024x1024"
-    if additional_parameters['aspect_ratio']['value'] == "landscape": additional_parameters['aspect_ratio']['value'] = "1792x1024"
-    if additional_parameters['aspect_ratio']['value'] == "portrait": additional_parameters['aspect_ratio']['value'] = "1024x1792"
-    
-    for i, batch in enumerate(batches):
-        yield {"message": f"Generating batch #{i+1} with {batch} image(s)...", "value":None, "type":"log", "level":None}
-        
-        async def get_image(prompt, size, quality, style, response_format = "b64_json"):
-            response = await client.images.generate(
-                model="dall-e-3",
-                prompt=prompt,
-                size=size,
-                quality=quality,
-                style=style,
-                response_format=response_format,
-                n=1
-            )
-            if response_format == "url": image = response.data[0].url
-            else: image = response.data[0].b64_json
-            return image
-
-        tasks = [get_image(prompt, additional_parameters['aspect_ratio']['value'], additional_parameters['quality']['value'], additional_parameters['style']['value'], response_format=response_format) for _ in range(batch)]
-        try: images = run_async_as_sync(asyncio.gather(*tasks))
-        except openai.AuthenticationError as e:
-            yield {"message": f"The API key for OpenAI is incorrect.", "value":e, "type":"error", "level":"critical"}
-        except openai.BadRequestError as e:
-            yield {"message": f"Provided prompt was rejected by OpenAI.", "value":e, "type":"error", "level":"critical"}
-        except openai.RateLimitError as e:
-            if "quota" in e.message:
-                yield {"message": f"Your OpenAI account does not have sufficient credits/balance.", "value":e, "type":"error", "level":"critical"}
-            else:
-                yield {"message": f"Too many requests sent to OpenAI. Please wait and try again later.", "value":e, "type":"error", "level":"warn"}
-        except Exception as e:
-            yield {"message": "Unknown error.", "value":e, "type":"error", "level":"warn"}
-        else:
-            yield {"message": f"Successfully generated batch #{i+1}!", "value": images, "type":response_format, "level": None}
-            
-def generate_dalle2(prompt, batches, additional_parameters):
-    
-    response_format = "b64_json"
-    
-    client = openai.AsyncOpenAI(api_key=SERVICES["OPENAI"]["api_key"])
-    
-    for i, batch in enumerate(batches):
-        yield {"message": f"Generating batch #{i+1} with {batch} image(s)...", "value":None, "type":"log", "level":None}
-        
-        async def get_image(prompt, response_format = "b64_json"):
-            response = await client.images.generate(
-                model="dall-e-2",
-                prompt=prompt,
-                size="1024x1024",
-                response_format=response_format
-            )
-            if response_format == "url": image = response.data[0].url
-            else: image = response.data[0].b64_json
-            return image
-
-        tasks = [get_image(prompt, response_format=response_format) for _ in range(batch)]
-        try: images = run_async_as_sync(asyncio.gather(*tasks))
-        except openai.AuthenticationError as e:
-            yield {"message": f"The API key for OpenAI is incorrect.", "value":e, "type":"error", "level":"critical"}
-        except openai.BadRequestError as e:
-            yield {"message": f"Provided prompt was rejected by OpenAI.", "value":e, "type":"error", "level":"critical"}
-        except openai.RateLimitError as e:
-            if "quota" in e.message:
-                yield {"message": f"Your OpenAI account does not have sufficient credits/balance.", "value":e, "type":"error", "level":"critical"}
-            else:
-                yield {"message": f"Too many requests sent to OpenAI. Please wait and try again later.", "value":e, "type":"error", "level":"warn"}
-        except Exception as e:
-            yield {"message": "Unknown error.", "value":e, "type":"error", "level":"warn"}
-        else:
-            yield {"message": f"Successfully generated batch #{i+1}!", "value": images, "type":response_format, "level": None}
-            
-def generate_sd3(prompt, batches, additional_parameters):
-    def generate_image(prompt, api_key, aspect_ratio):
-        response = requests.post(
-            f"https://api.stability.ai/v2beta/stable-image/generate/sd3",
-            headers={
-                "authorization": f"Bearer {api_key}",
-                "accept": "application/json"
-            },
-            files={"none": ''},
-            data={
-                "prompt": prompt,
-                "model": "sd3",
-                "output_format": "png",
-                "aspect_ratio": aspect_ratio
-            },
-        )
-        if response.status_code == 200: return response.json()["image"]
-        else: raise Exception(response.status_code)
-
-    async def get_image(prompt, api_key, aspect_ratio):
-        loop = asyncio.get_event_loop()
-        image = loop.run_in_executor(None, generate_image, prompt, api_key, aspect_ratio)
-        return await image
-    
-    for i, batch in enumerate(batches):
-        yield {"message": f"Generating batch #{i+1} with {batch} image(s)...", "value":None, "type":"log", "level":None}
-        tasks = [get_image(prompt, SERVICES["STABILITYAI"]["api_key"], additional_parameters['aspect_ratio']['value'] ) for _ in range(batch)]
-        
-        try: 
-            images = run_async_as_sync(asyncio.gather(*tasks))
-        except Exception as e:
-            status_code = int(str(e))
-            if status_code == 401:
-              yield {"message": f"The API key for StabilityAI is incorrect.", "value":e, "type":"error", "level":"critical"}  
-            elif status_code == 402:
-                yield {"message": f"Your OpenAI account does not have sufficient credits/balance.", "value":e, "type":"error", "level":"critical"}
-            elif status_code == 403:
-                yield {"message": f"Provided prompt was rejected by StabilityAI.", "value":e, "type":"error", "level":"critical"}
-            elif status_code == 429:
-                yield {"message": f"Too many requests sent to StabilityAI. Please wait and try again later.", "value":e, "type":"error", "level":"warn"}
-            elif status_code == 500:
-                yield {"message": f"StabilityAI faced an unexpected error.", "value":e, "type":"error", "level":"warn"}
+def openai_error_event(e):
+    if isinstance(e, openai.AuthenticationError):
+        return {"message": f"The API key for OpenAI is incorrect.", "value":e, "type":"error", "level":"critical"}
+    if isinstance(e, openai.BadRequestError):
+        return {"message": f"Provided prompt was rejected by OpenAI.", "value":e, "type":"error", "level":"critical"}
+    if isinstance(e, openai.RateLimitError):
+        if "quota" in e.message:
+            return {"message": f"Your OpenAI account does not have sufficient credits/balance.", "value":e, "type":"error", "level":"critical"}
+        return {"message": f"Too many requests sent to OpenAI. Please wait and try again later.", "value":e, "type":"error", "level":"warn"}
+    return {"message": "Unknown error.", "value":e, "type":"error", "level":"warn"}
+
+def stabilityai_error_event(e):
+    status_code = getattr(e, "status_code", None)
+    if status_code == 401:
+        return {"message": f"The API key for StabilityAI is incorrect.", "value":e, "type":"error", "level":"critical"}
+    if status_code == 402:
+        return {"message": f"Your StabilityAI account does not have sufficient credits/balance.", "value":e, "type":"error", "level":"critical"}
+    if status_code == 403:
+        return {"message": f"Provided prompt was rejected by StabilityAI.", "value":e, "type":"error", "level":"critical"}
+    if status_code == 429:
+        return {"message": f"Too many requests sent to StabilityAI. Please wait and try again later.", "value":e, "type":"error", "level":"warn"}
+    if status_code == 500:
+        return {"message": f"StabilityAI faced an unexpected error.", "value":e, "type":"error", "level":"warn"}
+    return {"message": f"Unknown error.", "value":e, "type":"error", "level":"warn"}
+
+def get_key_failure(e):
+    # "invalid" retires the key a request was sent with, "quota" parks it; either way the request moves on to another key
+    if isinstance(e, openai.AuthenticationError) or (isinstance(e, StabilityAIError) and e.status_code == 401): return "invalid"
+    if (isinstance(e, openai.RateLimitError) and "quota" in e.message) or (isinstance(e, StabilityAIError) and e.status_code == 402): return "quota"
+    return None
+
+def get_rate_limit_headers(e):
+    # Returns the response headers of a retryable rate limit error, or None for any other error
+    if isinstance(e, openai.RateLimitError) and "quota" not in e.message: return e.response.headers
+    if isinstance(e, StabilityAIError) and e.status_code == 429: return e.headers
+    return None
+
+def generate_scheduled(model_name, requests, amount, settings):
+    # requests yields (indexes, request_function) pairs, see scheduler.schedule()
+    service_key, model = find_model(model_name)
+    error_event = SERVICES[service_key]['error_event']
+    yield {"message": f"Generating {amount} image(s) with up to {settings['concurrency']} request(s) in flight...", "value":None, "type":"log", "level":None}
+
+    is_retryable = lambda e: error_event(e)['level'] != "critical"
+    key_pool = get_key_pool(service_key)
+    if not key_pool.usable():
+        # A spool host's .env may lack the key the job was checked against where it was queued
+        yield {"message": f"{SERVICES[service_key]['alias']} has no usable API key on this machine (missing, rejected or out of credits).", "value":None, "type":"error", "level":"critical"}
+        return
+    retired_keys = [key for key in key_pool.keys if key.retired]
+    outcomes = scheduler.schedule(model, requests, settings['concurrency'], key_pool, settings['max_attempts'], is_retryable, get_rate_limit_headers, get_key_failure)
+    stop_event = None
+    try:
+        for outcome in runtime.iterate(outcomes):
+            if outcome['error']:
+                failure_event = error_event(outcome['error'])
+                failure_event['message'] = f"Image #{outcome['index']} failed after {outcome['attempts']} attempt(s). {failure_event['message']}"
+                failure_event['index'] = outcome['index']
+                yield failure_event
             else:
-                yield {"message": f"Unknown error.", "value":e, "type":"error", "level":"warn"}
-        else:
-            yield {"message": f"Successfully generated batch #{i+1}!", "value": images, "type":"b64_json", "level": None}
-            
-def generate_sd3_turbo(prompt, batches, additional_parameters):
-    def generate_image(prompt, api_key, aspect_ratio):
-        response = requests.post(
-            f"https://api.stability.ai/v2beta/stable-image/generate/sd3",
-            headers={
-                "authorization": f"Bearer {api_key}",
-                "accept": "application/json"
-            },
-            files={"none": ''},
-            data={
-                "prompt": prompt,
-                "model": "sd3-turbo",
-                "output_format": "png",
-                "aspect_ratio": aspect_ratio
-            },
+                yield {"message": f"Generated image #{outcome['index']} in {outcome['attempts']} attempt(s).", "value": outcome['image'], "type":settings['transfer_mode'], "level": None, "index": outcome['index'],
+                       "attempts": outcome['attempts'], "latency": outcome['latency'], "request_id": outcome['request_id'], "provider": SERVICES[service_key]['alias']}
+    except scheduler.CircuitOpenError as e:
+        stop_event = {"message": f"{SERVICES[service_key]['alias']} is failing too often for {model['alias']}, so no more requests are sent for now. Try again in {math.ceil(e.retry_in)} second(s).", "value":e, "type":"error", "level":"critical"}
+    except scheduler.NoUsableKeyError as e:
+        stop_event = {"message": f"{SERVICES[service_key]['alias']} has no usable API key left.", "value":e, "type":"error", "level":"critical"}
+    except Exception as e: stop_event = error_event(e)
+    for key in key_pool.keys:
+        if key.retired and key not in retired_keys:
+            yield {"message": f"The {SERVICES[service_key]['alias']} API key ending in '{key.value[-4:]}' was rejected and is no longer used.", "value":None, "type":"log", "level":"warning"}
+    if stop_event: yield stop_event
+
+def generate_prompt(model_name, prompt, amount, additional_parameters, settings):
+    service_key, model = find_model(model_name)
+    request_function = model['request_function'](prompt, additional_parameters, settings)
+    yield from generate_scheduled(model_name, scheduler.pack_requests(model, request_function, amount), amount, settings)
+
+def generate_expansions(model_name, expansions, amount, settings):
+    # Many prompts as one schedule: expansions yields (indexes, prompt, parameters, additional_parameters) and is read lazily,
+    # one expansion at a time as the scheduler frees up slots; each image event also carries the prompt and parameters it was made with
+    service_key, model = find_model(model_name)
+    expanded = {}
+    expansion_error = None
+
+    def get_requests():
+        nonlocal expansion_error
+        try:
+            for indexes, prompt, parameters, additional_parameters in expansions:
+                request_function = model['request_function'](prompt, additional_parameters, settings)
+                for index in indexes: expanded[index] = (prompt, parameters)
+                for packed_indexes in scheduler.pack_indexes(indexes, model.get('images_per_request', 1)): yield packed_indexes, request_function
+        except (ValueError, OSError, csv.Error) as e: expansion_error = e
+
+    for event in generate_scheduled(model_name, get_requests(), amount, settings):
+        if event.get('index') in expanded:
+            prompt, parameters = expanded.pop(event['index'])
+            event.update(prompt=prompt, parameters=parameters)
+        yield event
+    if expansion_error: yield {"message": f"Template expansion stopped. {expansion_error}", "value":expansion_error, "type":"error", "level":"critical"}
+
+def get_openai_request(model_name, prompt, settings, **options):
+    response_format = settings['transfer_mode']
+
+    async def get_images(n, key):
+        raw_response = await runtime.get_openai_client(key.value).images.with_raw_response.generate(
+            model=model_name,
+            prompt=prompt,
+            response_format=response_format,
+            n=n,
+            **options
         )
-        if response.status_code == 200: return response.json()["image"]
-        else: raise Exception(response.status_code)
-
-    async def get_image(prompt, api_key, aspect_ratio):
-        loop = asyncio.get_event_loop()
-        image = loop.run_in_executor(None, generate_image, prompt, api_key, aspect_ratio)
-        return await image
-    
-    for i, batch in enumerate(batches):
-        yield {"message": f"Generating batch #{i+1} with {batch} image(s)...", "value":None, "type":"log", "level":None}
-        tasks = [get_image(prompt, SERVICES["STABILITYAI"]["api_key"], additional_parameters['aspect_ratio']['value'] ) for _ in range(batch)]
-        
-        try: 
-            images = run_async_as_sync(asyncio.gather(*tasks))
-        except Exception as e:
-            status_code = int(str(e))
-            if status_code == 401:
-              yield {"message": f"The API key for StabilityAI is incorrect.", "value":e, "type":"error", "level":"critical"}  
-            elif status_code == 402:
-                yield {"message": f"Your OpenAI account does not have sufficient credits/balance.", "value":e, "type":"error", "level":"critical"}
-            elif status_code == 403:
-                yield {"message": f"Provided prompt was rejected by StabilityAI.", "value":e, "type":"error", "level":"critical"}
-            elif status_code == 429:
-                yield {"message": f"Too many requests sent to StabilityAI. Please wait and try again later.", "value":e, "type":"error", "level":"warn"}
-            elif status_code == 500:
-                yield {"message": f"StabilityAI faced an unexpected error.", "value":e, "type":"error", "level":"warn"}
-            else:
-                yield {"message": f"Unknown error.", "value":e, "type":"error", "level":"warn"}
-        else:
-            yield {"message": f"Successfully generated batch #{i+1}!", "value": images, "type":"b64_json", "level": None}
-            
+        scheduler.observe(key, raw_response.headers)
+        response = raw_response.parse()
+        if response_format == "url": return {"images": [image.url for image in response.data], "request_id": raw_response.headers.get("x-request-id")}
+        else: return {"images": [image.b64_json for image in response.data], "request_id": raw_response.headers.get("x-request-id")}
+
+    return get_images
+
+def get_dalle3_request(prompt, additional_parameters, settings):
+    sizes = {"square": "1024x1024", "landscape": "1792x1024", "portrait": "1024x1792"}
+    size = sizes.get(additional_parameters['aspect_ratio']['value'], additional_parameters['aspect_ratio']['value'])
+    return get_openai_request("dall-e-3", prompt, settings, size=size, quality=additional_parameters['quality']['value'], style=additional_parameters['style']['value'])
+
+def get_dalle2_request(prompt, additional_parameters, settings):
+    return get_openai_request("dall-e-2", prompt, settings, size="1024x1024")
+
+def generate_dalle3(prompt, amount, additional_parameters, settings):
+    yield from generate_prompt("dalle-3", prompt, amount, additional_parameters, settings)
+
+def generate_dalle2(prompt, amount, additional_parameters, settings):
+    yield from generate_prompt("dalle-2", prompt, amount, additional_parameters, settings)
+
+async def generate_stabilityai_image(client, prompt, api_key, model, aspect_ratio, output_format, seed=None):
+    async with client.stream(
+        "POST",
+        f"https://api.stability.ai/v2beta/stable-image/generate/sd3",
+        headers={
+            "authorization": f"Bearer {api_key}",
+            "accept": "application/json"
+        },
+        files={"none": b''},
+        data={
+            "prompt": prompt,
+            "model": model,
+            "output_format": output_format,
+            "aspect_ratio": aspect_ratio,
+            **({"seed": str(seed)} if seed is not None else {})
+        }
+    ) as response:
+        body = bytearray()
+        async for chunk in response.aiter_bytes(): body.extend(chunk)
+        if response.status_code == 200: return {"images": [json.loads(body)["image"]], "request_id": response.headers.get("x-request-id")}
+        else: raise StabilityAIError(response.status_code, dict(response.headers))
+
+def get_stabilityai_request(model_name, prompt, additional_parameters, settings):
+    client = runtime.get_stabilityai_client(settings['concurrency'])
+
+    async def get_images(n, key):
+        return await generate_stabilityai_image(client, prompt, key.value, model_name, additional_parameters['aspect_ratio']['value'], settings['output_format'], settings.get('seed'))
+
+    return get_images
+
+def get_sd3_request(prompt, additional_parameters, settings):
+    return get_stabilityai_request("sd3", prompt, additional_parameters, settings)
+
+def get_sd3_turbo_request(prompt, additional_parameters, settings):
+    return get_stabilityai_request("sd3-turbo", prompt, additional_parameters, settings)
+
+def generate_sd3(prompt, amount, additional_parameters, settings):
+    yield from generate_prompt("sd3", prompt, amount, additional_parameters, settings)
+
+def generate_sd3_turbo(prompt, amount, additional_parameters, settings):
+    yield from generate_prompt("sd3-turbo", prompt, amount, additional_parameters, settings)
+
 SERVICES = {
     "OPENAI" : {
         "api_key" : None,
@@ -200,7 +224,10 @@ SERVICES = {
                     {"name" : "quality", "alias" : "Quality", "description" : "The quality of the image. Affects attention to detail, not resolution.", "default" : "standard", "options" : ["hd", "standard"]},
                     {"name" : "style", "alias" : "Style", "description" : "The style of the image. Vivid images are more dramatic and hyper-real than natural images.", "default" : "vivid", "options" : ["vivid", "natural"]}
                 ],
-                "generate_function" : generate_dalle3
+                "rate_limits" : {"requests_per_minute" : 7, "images_per_minute" : 7},
+                "transfer_modes" : ["url", "b64_json"],
+                "generate_function" : generate_dalle3,
+                "request_function" : get_dalle3_request
             },
             {
                 "name" : "dalle-2",
@@ -208,11 +235,16 @@ SERVICES = {
                 "online_only" : True,
                 "description" : "An older image generator that provides faster and cheaper but lower quality image generation.",
                 "additional_parameters" : None,
-                "generate_function" : generate_dalle2
+                "rate_limits" : {"requests_per_minute" : 50, "images_per_minute" : 50},
+                "images_per_request" : 10,
+                "transfer_modes" : ["url", "b64_json"],
+                "generate_function" : generate_dalle2,
+                "request_function" : get_dalle2_request
             },
         ],
         "always_verify" : False,
-        "verification_function" : verify_openai
+        "verification_function" : verify_openai,
+        "error_event" : openai_error_event
     },
     "STABILITYAI" : {
         "api_key" : None,
@@ -227,7 +259,11 @@ SERVICES = {
                 "online_only" : True,
                 "description" : "(Recommended) The newest image generator from StabilityAI.",
                 "additional_parameters" : [{"name" : "aspect_ratio", "alias" : "Aspect Ratio", "description" : "The aspect ratio/format of the generated image(s).", "default" : "1:1", "options" : ["16:9","1:1","21:9","2:3","3:2", "4:5", "5:4", "9:16", "9:21"]}],
-                "generate_function" : generate_sd3
+                "rate_limits" : {"requests_per_minute" : 150, "images_per_minute" : 150},
+                "output_formats" : ["png", "jpeg", "webp"],
+                "seeds" : True,
+                "generate_function" : generate_sd3,
+                "request_function" : get_sd3_request
             },
             {
                 "name" : "sd3-turbo",
@@ -235,10 +271,15 @@ SERVICES = {
                 "online_only" : True,
                 "description" : "A faster and cheaper version of Stable Diffusion 3",
                 "additional_parameters" : [{"name" : "aspect_ratio", "alias" : "Aspect Ratio", "description" : "The aspect ratio/format of the generated image(s).", "default" : "1:1", "options" : ["16:9","1:1","21:9","2:3","3:2", "4:5", "5:4", "9:16", "9:21"]}],
-                "generate_function" : generate_sd3_turbo
+                "rate_limits" : {"requests_per_minute" : 150, "images_per_minute" : 150},
+                "output_formats" : ["png", "jpeg", "webp"],
+                "seeds" : True,
+                "generate_function" : generate_sd3_turbo,
+                "request_function" : get_sd3_turbo_request
             },
         ],
         "always_verify" : False,
-        "verification_function" : None
+        "verification_function" : None,
+        "error_event" : stabilityai_error_event
     }
 }
\ No newline at end of file
@@ -0,0 +1,212 @@
+import utils, catalog, imaging
+import os, threading
+import numpy
+
+POPCOUNT_TABLE = numpy.array([bin(value).count("1") for value in range(256)], dtype=numpy.uint8)
+HASH_BATCH_SIZE = 256
+MAX_NEAR_DUPLICATE_DISTANCE = 8
+MATCH_CHUNK_SIZE = 65536
+
+hash_index = None
+hash_index_lock = threading.Lock()
+
+def popcount(values):
+    if hasattr(numpy, "bitwise_count"): return numpy.bitwise_count(values)
+    return POPCOUNT_TABLE[values.view(numpy.uint8)].reshape(values.shape + (8,)).sum(axis=-1)
+
+def to_unsigned(phash):
+    return numpy.int64(phash).astype(numpy.uint64)
+
+class HashIndex:
+    # Packed matrix of every catalogued perceptual hash, compared against a new hash in one vectorised pass
+    # Locked, since a comparison checks the images of each of its models from that model's own thread
+    def __init__(self, image_ids, hashes):
+        self.image_ids = image_ids
+        self.hashes = hashes
+        self.size = len(hashes)
+        self.lock = threading.Lock()
+
+    def add(self, image_id, phash):
+        with self.lock:
+            if self.size == len(self.hashes):
+                capacity = max(1024, self.size * 2)
+                self.image_ids = numpy.resize(self.image_ids, capacity)
+                self.hashes = numpy.resize(self.hashes, capacity)
+            self.image_ids[self.size] = image_id
+            self.hashes[self.size] = to_unsigned(phash)
+            self.size += 1
+
+    def find(self, phash, max_distance):
+        with self.lock:
+            distances = popcount(self.hashes[:self.size] ^ to_unsigned(phash))
+            matches = numpy.flatnonzero(distances <= max_distance)
+            matches = matches[numpy.argsort(distances[matches], kind="stable")]
+            return [(int(self.image_ids[match]), int(distances[match])) for match in matches]
+
+def load_hash_matrix():
+    rows = catalog.connect().execute("SELECT rowid, phash FROM images WHERE phash IS NOT NULL").fetchall()
+    image_ids = numpy.fromiter((row[0] for row in rows), dtype=numpy.int64, count=len(rows))
+    hashes = numpy.fromiter((row[1] for row in rows), dtype=numpy.int64, count=len(rows)).astype(numpy.uint64)
+    return image_ids, hashes
+
+def get_hash_index():
+    global hash_index
+    with hash_index_lock:
+        if hash_index is None: hash_index = HashIndex(*load_hash_matrix())
+        return hash_index
+
+def get_image(image_id):
+    row = catalog.connect().execute("SELECT images.rowid AS image_id, generations.title, images.file_name, images.hash, images.phash FROM images JOIN generations ON generations.id = images.generation_id WHERE images.rowid = ?", (image_id,)).fetchone()
+    return dict(row) if row else None
+
+def get_image_path(image):
+    return f"{catalog.get_folder_path(image['title'])}/{image['file_name']}"
+
+def get_image_name(image):
+    return f"{image['title']}/{image['file_name']}"
+
+def set_perceptual_hash(image_id, phash):
+    connection = catalog.connect()
+    with connection: connection.execute("UPDATE images SET phash = ? WHERE rowid = ?", (phash, image_id))
+
+def hardlink(source_path, image_id, image_path):
+    # Swaps image_path for a hardlink to source_path; skipped where hardlinks aren't possible since a copy would save nothing
+    try:
+        if os.path.samefile(source_path, image_path): return False
+    except OSError: return False
+    folder_path, file_name = os.path.split(image_path)
+    temp_path = f"{folder_path}/.{file_name}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        os.link(source_path, temp_path)
+        os.replace(temp_path, image_path)
+    except OSError:
+        try: os.remove(temp_path)
+        except OSError: pass
+        return False
+    # The link carries the source's mtime, recorded here so the next reconcile doesn't rehash it
+    connection = catalog.connect()
+    with connection:
+        connection.execute("UPDATE images SET mtime = ? WHERE rowid = ?", (os.stat(image_path).st_mtime, image_id))
+        connection.execute("UPDATE generations SET folder_mtime = ? WHERE id = (SELECT generation_id FROM images WHERE rowid = ?)", (catalog.get_folder_mtime(get_image(image_id)['title']), image_id))
+    return True
+
+def collapse_exact(image_id, image_path, file_hash):
+    # Links the image to the earliest catalogued image with the same content, returning that image
+    row = catalog.connect().execute("SELECT rowid FROM images WHERE hash = ? AND rowid != ? ORDER BY rowid LIMIT 1", (file_hash, image_id)).fetchone()
+    if not row: return None
+    original = get_image(row[0])
+    if not os.path.exists(get_image_path(original)): return None
+    hardlink(get_image_path(original), image_id, image_path)
+    return original
+
+def find_near_duplicates(image_id, phash, max_distance):
+    # Stale matrix entries (deleted or rehashed images) are dropped by rechecking the hash the catalog holds now
+    near_duplicates = []
+    for match_id, distance in get_hash_index().find(phash, max_distance):
+        if match_id == image_id: continue
+        match = get_image(match_id)
+        if match and match['phash'] is not None and int(popcount(numpy.array([to_unsigned(match['phash']) ^ to_unsigned(phash)]))[0]) == distance:
+            near_duplicates.append((match, distance))
+    return near_duplicates
+
+def check_image(image_id, image_path, file_hash, phash, max_distance):
+    # Incremental pass for one freshly saved image: returns (exact duplicate or None, [(near-duplicate, distance)])
+    original = collapse_exact(image_id, image_path, file_hash)
+    near_duplicates = []
+    if phash is not None:
+        # The index is loaded before this image's hash is stored, otherwise the first image checked would end up in it twice
+        index = get_hash_index()
+        set_perceptual_hash(image_id, phash)
+        if not original: near_duplicates = find_near_duplicates(image_id, phash, max_distance)
+        index.add(image_id, phash)
+    return original, near_duplicates
+
+def backfill_perceptual_hashes():
+    # Hashes every catalogued image that doesn't have a perceptual hash yet, decoding on utils' process pool
+    connection = catalog.connect()
+    images = [dict(row) for row in connection.execute("SELECT images.rowid AS image_id, generations.title, images.file_name FROM images JOIN generations ON generations.id = images.generation_id WHERE images.phash IS NULL")]
+    hashed = 0
+    for start in range(0, len(images), HASH_BATCH_SIZE):
+        batch = images[start:start+HASH_BATCH_SIZE]
+        futures = [utils.get_transcode_pool().submit(imaging.get_perceptual_hash, get_image_path(image)) for image in batch]
+        updates = []
+        for image, future in zip(batch, futures):
+            try: updates.append((future.result(), image['image_id']))
+            except Exception: continue
+        with connection: connection.executemany("UPDATE images SET phash = ? WHERE rowid = ?", updates)
+        hashed += len(updates)
+    return hashed
+
+def collapse_all_exact():
+    # Every group of identical files is linked to its earliest member
+    connection = catalog.connect()
+    linked = 0
+    for group in connection.execute("SELECT hash FROM images WHERE hash IS NOT NULL GROUP BY hash HAVING COUNT(*) > 1").fetchall():
+        image_ids = [row[0] for row in connection.execute("SELECT rowid FROM images WHERE hash = ? ORDER BY rowid", (group[0],))]
+        images = [image for image in map(get_image, image_ids) if image and os.path.exists(get_image_path(image))]
+        for image in images[1:]:
+            if hardlink(get_image_path(images[0]), image['image_id'], get_image_path(image)): linked += 1
+    return linked
+
+def get_band_matches(order, bucket_starts, bucket_counts, queries, start, end):
+    # Every (i, j) with keys[j] == queries[i] for i in start..end; bands are narrow enough to index a table of every key directly
+    first = bucket_starts[queries[start:end]]
+    counts = bucket_counts[queries[start:end]]
+    total = int(counts.sum())
+    if not total: return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64)
+    offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return numpy.repeat(numpy.arange(start, end), counts), order[numpy.repeat(first, counts) + offsets]
+
+def find_near_duplicate_pairs(hashes, max_distance):
+    # Multi-index hashing: split the 64 bits into bands, two hashes within max_distance then have a band that differs in at most
+    # max_distance // band_count bits (never more than one), so each band is matched exactly and with each of its bits flipped
+    # At least 3 bands keeps them narrow enough to look up, and up to MAX_NEAR_DUPLICATE_DISTANCE they stay 12 bits or wider, which keeps the candidates a small fraction of all pairs
+    max_distance = min(max_distance, MAX_NEAR_DUPLICATE_DISTANCE)
+    band_count = max(3, (max_distance + 2) // 2)
+    band_edges = [64 * band // band_count for band in range(band_count + 1)]
+    pairs = []
+    for band in range(band_count):
+        width = band_edges[band+1] - band_edges[band]
+        keys = ((hashes >> numpy.uint64(band_edges[band])) & numpy.uint64((1 << width) - 1)).astype(numpy.int64)
+        order = numpy.argsort(keys, kind="stable")
+        bucket_counts = numpy.bincount(keys, minlength=1 << width)
+        bucket_starts = numpy.cumsum(bucket_counts) - bucket_counts
+        flips = range(width) if max_distance // band_count else []
+        for queries in [keys] + [keys ^ (1 << flip) for flip in flips]:
+            # In chunks, so a crowded band never has to hold every candidate pair at once
+            for start in range(0, len(keys), MATCH_CHUNK_SIZE):
+                first, second = get_band_matches(order, bucket_starts, bucket_counts, queries, start, min(len(keys), start + MATCH_CHUNK_SIZE))
+                candidates = first < second
+                first, second = first[candidates], second[candidates]
+                close = popcount(hashes[first] ^ hashes[second]) <= max_distance
+                if close.any(): pairs.append(numpy.stack([first[close], second[close]], axis=1))
+    if not pairs: return numpy.empty((0, 2), dtype=numpy.int64)
+    return numpy.unique(numpy.concatenate(pairs), axis=0)
+
+def get_components(size, pairs):
+    # Connected components without a Python loop per pair: every node takes the smallest label among its neighbours,
+    # then labels are followed to their own labels until nothing changes
+    labels = numpy.arange(size)
+    if not len(pairs): return labels
+    first, second = pairs[:, 0], pairs[:, 1]
+    while True:
+        smallest = numpy.minimum(labels[first], labels[second])
+        updated = labels.copy()
+        numpy.minimum.at(updated, first, smallest)
+        numpy.minimum.at(updated, second, smallest)
+        while True:
+            jumped = updated[updated]
+            if numpy.array_equal(jumped, updated): break
+            updated = jumped
+        if numpy.array_equal(updated, labels): return labels
+        labels = updated
+
+def find_near_duplicate_groups(max_distance):
+    image_ids, hashes = load_hash_matrix()
+    pairs = find_near_duplicate_pairs(hashes, max_distance)
+    if not len(pairs): return []
+    nodes = numpy.unique(pairs.ravel())
+    labels = get_components(len(hashes), pairs)[nodes]
+    order = numpy.lexsort((image_ids[nodes], labels))
+    group_starts = numpy.flatnonzero(numpy.diff(labels[order], prepend=-1))
+    return [group.tolist() for group in numpy.split(image_ids[nodes][order], group_starts[1:])]
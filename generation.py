@@ -0,0 +1,536 @@
+import data, utils, imaging, cache, catalog, dedupe, thumbnails, journal, templates
+import os, csv, json, queue, datetime, sqlite3, threading
+from concurrent import futures
+
+IMAGE_RECORDS_FILE_NAME = "images.jsonl"
+MAX_SEED = 4294967294
+
+def get_timestamp():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H-%M-%S')
+
+def unique_title(title, taken=(), next_suffixes=None):
+    # next_suffixes ({title: suffix}) carries on from the last suffix handed out, so titling every untitled line of a manifest stays linear
+    suffix = next_suffixes.get(title, 1) if next_suffixes is not None else 1
+    candidate = f"{title} ({suffix})" if suffix > 1 else title
+    while candidate in taken or os.path.exists(f"{utils.GENERATIONS_FOLDER}/{candidate}"):
+        suffix += 1
+        candidate = f"{title} ({suffix})"
+    if next_suffixes is not None: next_suffixes[title] = suffix + 1
+    return candidate
+
+def normalise_job(job, config):
+    if not isinstance(job, dict): raise ValueError("Job must be a JSON object.")
+
+    service_key, model = data.find_model(job.get('model'))
+    if not model: raise ValueError(f"Unknown model '{job.get('model')}'.")
+    if not data.SERVICES[service_key]['api_key']: raise ValueError(f"Service '{data.SERVICES[service_key]['alias']}' has not been added.")
+
+    prompt = job.get('prompt')
+    if not isinstance(prompt, str) or len(prompt.strip()) < 3: raise ValueError("Prompt must have a length of at least 3.")
+    prompt = prompt.strip()
+    if len(prompt) > 5000: raise ValueError("Prompt must be no longer than 5000 characters.")
+
+    amount = job.get('amount', 1)
+    if type(amount) != int or amount not in range(1, config['MAX_IMAGES']['value']+1):
+        raise ValueError(f"Image amount not in range 1-{config['MAX_IMAGES']['value']}.")
+
+    given_parameters = job.get('parameters') or {}
+    if not isinstance(given_parameters, dict): raise ValueError("Parameters must be a JSON object.")
+    known_parameters = model['additional_parameters'] or []
+    for name in given_parameters.keys():
+        if name not in [parameter['name'] for parameter in known_parameters]:
+            raise ValueError(f"Unknown parameter '{name}' for model '{model['name']}'.")
+    parameters = {}
+    for parameter in known_parameters:
+        value = given_parameters.get(parameter['name'], parameter['default'])
+        if value not in parameter['options']:
+            raise ValueError(f"Invalid option '{value}' for parameter '{parameter['name']}' (options: {', '.join(parameter['options'])}).")
+        parameters[parameter['name']] = value
+
+    timestamp = job.get('timestamp') or get_timestamp()
+    title = job.get('title') or timestamp
+    if not isinstance(title, str): raise ValueError("Title must be a string.")
+    title = title.strip()
+    if len(title) < 3: raise ValueError("Title must have a length of at least 3.")
+    if len(title) > 1000: raise ValueError("Title must be no longer than 1000 characters.")
+
+    output_format = job.get('output_format', "png")
+    if output_format not in imaging.OUTPUT_FORMATS:
+        raise ValueError(f"Invalid output format '{output_format}' (options: {', '.join(imaging.OUTPUT_FORMATS)}).")
+
+    transfer_mode = job.get('transfer_mode', "auto")
+    if transfer_mode not in ["auto"] + model.get('transfer_modes', ["b64_json"]):
+        raise ValueError(f"Invalid transfer mode '{transfer_mode}' for model '{model['name']}' (options: {', '.join(['auto'] + model.get('transfer_modes', ['b64_json']))}).")
+
+    normalised_job = {"model": model['name'], "prompt": prompt, "amount": amount, "parameters": parameters, "title": title, "timestamp": timestamp, "output_format": output_format, "transfer_mode": transfer_mode}
+    seed = job.get('seed')
+    if seed is not None:
+        if not model.get('seeds'): raise ValueError(f"Model '{model['name']}' does not take a seed.")
+        if type(seed) != int or seed not in range(0, MAX_SEED+1): raise ValueError(f"Seed not in range 0-{MAX_SEED}.")
+        # The same seed gives the same image every time, so more than one would only be paid for twice
+        if amount != 1: raise ValueError("Image amount must be 1 with a seed.")
+        normalised_job['seed'] = seed
+    return normalised_job
+
+def map_parameter(model, name, value):
+    # Returns the model's option for value (or for an equivalent of it), or None when the model has no such parameter
+    parameter = next((parameter for parameter in model['additional_parameters'] or [] if parameter['name'] == name), None)
+    if not parameter: return None
+    if value in parameter['options']: return value
+    for options in data.EQUIVALENT_OPTIONS.get(name, []):
+        if value not in options: continue
+        for option in options:
+            if option in parameter['options']: return option
+    raise ValueError(f"Option '{value}' for parameter '{name}' has no equivalent for model '{model['name']}' (options: {', '.join(parameter['options'])}).")
+
+def normalise_comparison_job(job, config):
+    # A comparison sends one prompt to several models at once; each model's share is an ordinary job saved into a subfolder named after it
+    if not isinstance(job, dict): raise ValueError("Job must be a JSON object.")
+    models = job.get('models')
+    if not isinstance(models, list) or len(models) < 2 or len(set(map(str, models))) != len(models): raise ValueError("Models must be a list of at least two different models.")
+    given_parameters = job.get('parameters') or {}
+    if not isinstance(given_parameters, dict): raise ValueError("Parameters must be a JSON object.")
+
+    timestamp = job.get('timestamp') or get_timestamp()
+    model_jobs = []
+    mapped_names = set()
+    for model_name in models:
+        service_key, model = data.find_model(model_name)
+        if not model: raise ValueError(f"Unknown model '{model_name}'.")
+        parameters = {}
+        for name, value in given_parameters.items():
+            option = map_parameter(model, name, value)
+            if option is None: continue
+            parameters[name] = option
+            mapped_names.add(name)
+        transfer_mode = job.get('transfer_mode', "auto") if job.get('transfer_mode', "auto") in model.get('transfer_modes', ["b64_json"]) else "auto"
+        seed = job.get('seed') if model.get('seeds') else None
+        model_job = normalise_job(dict(job, model=model_name, parameters=parameters, timestamp=timestamp, transfer_mode=transfer_mode, seed=seed), config)
+        model_jobs.append(dict(model_job, subfolder=model_name))
+    for name in given_parameters.keys():
+        if name not in mapped_names: raise ValueError(f"Unknown parameter '{name}' for models '{', '.join(models)}'.")
+    if job.get('seed') is not None and not any(model_job.get('seed') is not None for model_job in model_jobs): raise ValueError(f"None of the models '{', '.join(models)}' take a seed.")
+
+    first_job = model_jobs[0]
+    return {"model": ", ".join(models), "models": models, "prompt": first_job['prompt'], "amount": first_job['amount'], "parameters": given_parameters, "title": first_job['title'],
+            "timestamp": timestamp, "output_format": first_job['output_format'], "transfer_mode": job.get('transfer_mode', "auto"), "jobs": model_jobs}
+
+def normalise_template_job(job, config):
+    # A template expands into one prompt per combination of its variables, and every expansion runs through one schedule as one job
+    # amount is per expansion; expanding in full here rejects a bad row before anything is queued and fixes how many images to expect
+    if not isinstance(job, dict): raise ValueError("Job must be a JSON object.")
+    if "models" in job: raise ValueError("Templates run on a single model.")
+    template_job = normalise_job(dict(job, prompt=job.get('template')), config)
+    service_key, model = data.find_model(template_job['model'])
+    if not model.get('request_function'): raise ValueError(f"Model '{model['name']}' does not support templates.")
+    fields = templates.get_fields(template_job['prompt'])
+
+    variables = job.get('variables') or {}
+    if not isinstance(variables, dict) or not all(isinstance(values, list) and values and all(isinstance(value, str) for value in values) for values in variables.values()):
+        raise ValueError("Variables must map each name to a non-empty list of strings.")
+    csv_path = job.get('csv')
+    columns = []
+    if csv_path is not None:
+        if not isinstance(csv_path, str): raise ValueError("CSV must be a file path.")
+        csv_path = os.path.abspath(csv_path)
+        try: columns = templates.read_csv_header(csv_path)
+        except (OSError, UnicodeDecodeError) as e: raise ValueError(f"Failed to read CSV '{csv_path}' ({e}).")
+    if not variables and not csv_path: raise ValueError("Template needs variables or a CSV.")
+
+    parameter_names = [parameter['name'] for parameter in model['additional_parameters'] or []]
+    for name in variables.keys():
+        if name not in fields and name not in parameter_names: raise ValueError(f"Variable '{name}' is neither a placeholder of the template nor a parameter of model '{model['name']}'.")
+    for field in fields:
+        if field not in variables and field not in columns: raise ValueError(f"Placeholder '{{{field}}}' has no variable or CSV column.")
+    expand = job.get('expand', "cartesian")
+    if expand not in templates.EXPANSION_MODES: raise ValueError(f"Invalid expansion '{expand}' (options: {', '.join(templates.EXPANSION_MODES)}).")
+
+    template_job.update(template=template_job['prompt'], variables=variables, csv=csv_path, expand=expand)
+    try: template_job['expansions'] = templates.count_expansions(template_job, model)
+    except (OSError, UnicodeDecodeError, csv.Error) as e: raise ValueError(f"Failed to read CSV '{csv_path}' ({e}).")
+    if not template_job['expansions']: raise ValueError("Template has no expansions.")
+    return template_job
+
+def normalise_any_job(job, config):
+    if isinstance(job, dict) and "template" in job: return normalise_template_job(job, config)
+    if isinstance(job, dict) and "models" in job: return normalise_comparison_job(job, config)
+    return normalise_job(job, config)
+
+def get_image_total(job):
+    if job.get('jobs'): return sum(map(get_image_total, job['jobs']))
+    return job['amount'] * job.get('expansions', 1)
+
+def get_expansion_requests(job, model, skip):
+    # Expansion k owns image numbers k*amount+1 to (k+1)*amount, so a resumed template only asks for the numbers it is missing
+    for position, (prompt, parameters) in enumerate(templates.expand(job, model)):
+        numbers = [number for number in range(position * job['amount'] + 1, (position + 1) * job['amount'] + 1) if number not in skip]
+        if numbers: yield numbers, prompt, parameters, get_additional_parameters(model, parameters)
+
+def get_job_folder(job):
+    folder_path = f"{utils.GENERATIONS_FOLDER}/{job['title']}"
+    return f"{folder_path}/{job['subfolder']}" if job.get('subfolder') else folder_path
+
+def get_additional_parameters(model, parameters):
+    additional_parameters = {}
+    for parameter in model['additional_parameters'] or []:
+        additional_parameters[parameter['name']] = {"alias": parameter['alias'], "value": parameters[parameter['name']]}
+    return additional_parameters
+
+def write_settings(folder_path, model, job, additional_parameters):
+    with open(f"{folder_path}/settings.txt", 'w') as f:
+        settings_message = f"Generation Settings\n\n{'Template' if job.get('template') else 'Prompt'}: {job['prompt']}\nTimestamp: {job['timestamp']}\nModel: {model['alias']}\nImage Amount: {job['amount']}"
+        if job.get('template'): settings_message += f" per expansion\nExpansions: {job['expansions']} ({job['expand']})"
+        settings_message += f"\nOutput Format: {job.get('output_format', 'png')}"
+        if job.get('seed') is not None: settings_message += f"\nSeed: {job['seed']}"
+        varied = templates.get_parameter_variable_names(job) if job.get('template') else set()
+        for name, parameter in additional_parameters.items():
+            settings_message += f"\n{parameter['alias']}: {'varies' if name in varied else parameter['value']}"
+        f.write(settings_message)
+
+def write_metadata(folder_path, model, job, image_records):
+    # settings.json is the machine-readable twin of settings.txt, written when the generation starts and again with every image record once it ends
+    service_key, _ = data.find_model(model['name'])
+    metadata = {
+        "title": job['title'],
+        "prompt": job['prompt'],
+        "model": model['name'],
+        "provider": data.SERVICES[service_key]['alias'],
+        "parameters": job['parameters'],
+        "timestamp": job['timestamp'],
+        "amount": get_image_total(job),
+        "output_format": job.get('output_format', "png"),
+        "transfer_mode": job.get('transfer_mode', "auto"),
+        "images": sorted(image_records, key=lambda record: record['number'])
+    }
+    if job.get('template'): metadata.update(expansions=job['expansions'], expand=job['expand'])
+    if job.get('seed') is not None: metadata['seed'] = job['seed']
+    utils.write_atomically(f"{folder_path}/settings.json", lambda file: file.write(json.dumps(metadata, indent=4).encode('utf-8')))
+
+def get_png_text(model, job):
+    # Only what every image of an identical job shares, so cached variants stay accurate when reused elsewhere
+    return {
+        "Description": job['prompt'],
+        "Software": f"ImagineSuite {utils.VERSION}",
+        "ImagineSuite": json.dumps({"prompt": job['prompt'], "model": model['name'], "parameters": job['parameters'], **({"seed": job['seed']} if job.get('seed') is not None else {})}, sort_keys=True)
+    }
+
+def save_image(image_type, image, image_path, transcode_format, png_text, perceptual_hash):
+    # Runs on the save pools, so hashing happens off the thread consuming the provider's results
+    image_path = utils.save_image(image_type, image, image_path, transcode_format, png_text)
+    phash = None
+    if perceptual_hash:
+        try: phash = utils.get_transcode_pool().submit(imaging.get_perceptual_hash, image_path).result()
+        except Exception: pass
+    file_hash = cache.hash_file(image_path)
+    try: thumbnails.submit_thumbnail(image_path, file_hash)
+    except OSError: pass
+    return image_path, os.path.getsize(image_path), file_hash, phash
+
+def get_duplicate_events(number, image_id, image_path, image_record, phash, config):
+    try: original, near_duplicates = dedupe.check_image(image_id, image_path, image_record['hash'], phash, config['NEAR_DUPLICATE_DISTANCE']['value'])
+    except (sqlite3.Error, OSError): return []
+    if original: return [{"message": f"Image {number} is identical to '{dedupe.get_image_name(original)}', hardlinked to save space.", "value":None, "type":"log", "level":"debug"}]
+    if not near_duplicates: return []
+    names = ", ".join(f"'{dedupe.get_image_name(match)}'" for match, distance in near_duplicates[:3])
+    if len(near_duplicates) > 3: names += f" and {len(near_duplicates) - 3} more"
+    return [{"message": f"Image {number} looks like a near-duplicate of {names}.", "value":None, "type":"log", "level":"debug"}]
+
+def get_transfer_mode(model, job):
+    # "auto" prefers URLs: API responses stay small and downloads overlap with the requests still in flight
+    transfer_modes = model.get('transfer_modes', ["b64_json"])
+    transfer_mode = job.get('transfer_mode', "auto")
+    if transfer_mode == "auto": return "url" if "url" in transfer_modes else transfer_modes[0]
+    return transfer_mode
+
+def get_native_format(model, job):
+    # Formats the provider can't return directly are saved as PNG first and transcoded on utils' process pool
+    output_format = job.get('output_format', "png")
+    return output_format if output_format in model.get('output_formats', ["png"]) else "png"
+
+def get_generation_settings(model, job, config):
+    return {"concurrency": config['MAX_CONCURRENCY']['value'], "max_attempts": config['MAX_ATTEMPTS']['value'], "transfer_mode": get_transfer_mode(model, job), "output_format": get_native_format(model, job), "seed": job.get('seed')}
+
+def append_image_record(folder_path, image_record):
+    # One line per saved image, rewriting settings.json for each would cost more with every image a generation already has
+    with open(f"{folder_path}/{IMAGE_RECORDS_FILE_NAME}", 'a', encoding='utf-8') as f: f.write(json.dumps(image_record) + "\n")
+
+def read_image_records(folder_path):
+    # settings.json's images plus the ones only appended so far, a later record for the same image replaces the earlier one and a torn last line is skipped
+    try:
+        with open(f"{folder_path}/settings.json", 'r', encoding='utf-8') as f: image_records = json.load(f)['images']
+    except (OSError, ValueError, KeyError): image_records = []
+    try:
+        with open(f"{folder_path}/{IMAGE_RECORDS_FILE_NAME}", 'r', encoding='utf-8') as f:
+            for line in f:
+                try: image_records.append(json.loads(line))
+                except ValueError: continue
+    except OSError: pass
+    return list({image_record.get('number', image_record.get('file')): image_record for image_record in image_records}.values())
+
+def read_saved_image_records(folder_path):
+    return [image_record for image_record in read_image_records(folder_path) if image_record.get('file') and os.path.exists(f"{folder_path}/{image_record['file']}")]
+
+def finish_metadata(folder_path, write):
+    # Folds the appended image records into settings.json, however the generation ended
+    try:
+        write(read_saved_image_records(folder_path))
+        os.remove(f"{folder_path}/{IMAGE_RECORDS_FILE_NAME}")
+    except OSError: pass
+
+def read_comparison_job(folder_path):
+    try:
+        with open(f"{folder_path}/settings.json", 'r', encoding='utf-8') as f: return json.load(f).get('job')
+    except (OSError, ValueError, AttributeError): return None
+
+def count_journaled_images(folder_path):
+    if not os.path.exists(journal.get_journal_path(folder_path)): return None
+    state = journal.read_journal(folder_path)
+    return len([file_name for file_name in state['saved'].values() if os.path.exists(f"{folder_path}/{file_name}")])
+
+def count_saved_images(title):
+    # Images the journal recorded as saved that are still on disk, or None for generations without a journal
+    # A comparison adds up the journals of its model subfolders
+    folder_path = f"{utils.GENERATIONS_FOLDER}/{title}"
+    comparison_job = read_comparison_job(folder_path)
+    if comparison_job: return sum(count_journaled_images(f"{folder_path}/{model_job['subfolder']}") or 0 for model_job in comparison_job['jobs'])
+    return count_journaled_images(folder_path)
+
+def load_resume_job(title):
+    # Returns the journaled job of an unfinished generation, raising ValueError when there is nothing to resume
+    folder_path = f"{utils.GENERATIONS_FOLDER}/{title}"
+    comparison_job = read_comparison_job(folder_path)
+    if comparison_job:
+        if count_saved_images(title) >= get_image_total(comparison_job): raise ValueError(f"Generation '{title}' already has all {get_image_total(comparison_job)} of its image(s).")
+        return dict(comparison_job, title=title)
+    if not os.path.exists(journal.get_journal_path(folder_path)): raise ValueError(f"Generation '{title}' has no journal to resume from.")
+    state = journal.read_journal(folder_path)
+    if not state['job']: raise ValueError(f"The journal of generation '{title}' is missing its job.")
+    if count_saved_images(title) >= get_image_total(state['job']): raise ValueError(f"Generation '{title}' already has all {get_image_total(state['job'])} of its image(s).")
+    return dict(state['job'], title=title)
+
+def generate(job, config, resume=False):
+    # Yields the provider's log/error events plus "image" (saved file path) events, independent of any UI
+    # With resume, an interrupted generation continues from its journal: only missing images are requested and numbering carries on
+    if job.get('jobs'):
+        yield from generate_comparison(job, config, resume)
+        return
+    service_key, model = data.find_model(job['model'])
+    folder_path = get_job_folder(job)
+    additional_parameters = get_additional_parameters(model, job['parameters'])
+
+    try:
+        if resume:
+            state = journal.read_journal(folder_path)
+            job_journal = journal.Journal(folder_path)
+        else:
+            os.makedirs(folder_path)
+            job_journal = journal.Journal(folder_path)
+            job_journal.write("started", job=job)
+            write_settings(folder_path, model, job, additional_parameters)
+            write_metadata(folder_path, model, job, [])
+    except Exception as e:
+        yield {"message": f"Failed to {'resume' if resume else 'create'} generation folder '{job['title']}'.", "value":e, "type":"error", "level":"critical"}
+        return
+
+    try: yield from generate_images(job, config, resume and state, model, folder_path, additional_parameters, job_journal)
+    finally:
+        job_journal.close()
+        finish_metadata(folder_path, lambda image_records: write_metadata(folder_path, model, job, image_records))
+
+def generate_images(job, config, state, model, folder_path, additional_parameters, job_journal):
+    def record_image(image_record, image_path):
+        # The catalog is only an index, anything missed here is picked up by the next catalog.reconcile()
+        try: append_image_record(folder_path, image_record)
+        except OSError: pass
+        try: return catalog.add_image(job['title'], image_path, image_record['hash'])
+        except (sqlite3.Error, OSError): return None
+
+    image_count = 0
+    images_saved = 0
+    pending_saves = {}
+    native_format = get_native_format(model, job)
+    transcode_format = job.get('output_format', "png") if job.get('output_format', "png") != native_format else None
+    cache_key = cache.get_cache_key(job, job.get('output_format', "png")) if config['USE_CACHE']['value'] and not job.get('template') else None
+    png_text = get_png_text(model, job)
+
+    if state:
+        # Images already on disk are kept, and the numbering carries on past every number the journal has handed out
+        saved_files = [file_name for file_name in state['saved'].values() if os.path.exists(f"{folder_path}/{file_name}")]
+        image_count = state['last_number']
+        images_saved = len(saved_files)
+        job_journal.write("resumed", images_saved=images_saved)
+        yield {"message": f"Resuming with {images_saved} image(s) out of {get_image_total(job)} already saved.", "value":None, "type":"log", "level":"debug"}
+        try: catalog.reconcile_folder(job['title'])
+        except (sqlite3.Error, OSError): pass
+    elif not job.get('subfolder'):
+        try: catalog.add_generation(dict(job, amount=get_image_total(job)))
+        except (sqlite3.Error, OSError): pass
+
+    if cache_key and not state:
+        for variant_path in cache.lookup(cache_key, job['amount']):
+            image_count += 1
+            image_path = f"{folder_path}/{image_count}{os.path.splitext(variant_path)[1]}"
+            try: cache.restore(variant_path, image_path)
+            except OSError as e:
+                yield {"message": f"Failed to reuse cached image for {image_count}! Continuing...", "value":e, "type":"log", "level":"warning"}
+                image_count -= 1
+                continue
+            images_saved += 1
+            job_journal.write("saved", number=image_count, file=os.path.basename(image_path), cached=True)
+            try: record_image({"number": image_count, "file": os.path.basename(image_path), "cached": True, "request_id": None, "latency": None, "provider": None, "attempts": 0, "bytes": os.path.getsize(image_path), "hash": os.path.splitext(os.path.basename(variant_path))[0]}, image_path)
+            except OSError: pass
+            yield {"message": f"Reused cached image. Saved as {os.path.basename(image_path)}.", "value":image_path, "type":"image", "level":None}
+        if images_saved: yield {"message": f"Filled {images_saved} image(s) out of {job['amount']} from the cache.", "value":None, "type":"log", "level":"success"}
+
+    def finish_saves(return_when):
+        # Saving runs on utils.save_pool (or download_pool for URLs); waiting once every worker is busy keeps only a few payloads in memory
+        nonlocal images_saved
+        events = []
+        if not pending_saves: return events
+        done, _ = futures.wait(pending_saves.keys(), timeout=None if return_when else 0, return_when=return_when or futures.FIRST_COMPLETED)
+        for future in done:
+            number, message, image_record = pending_saves.pop(future)
+            if future.exception():
+                job_journal.write("failed", number=number, reason=str(future.exception()))
+                events.append({"message": f"Failed to save image {number}! Continuing...", "value":future.exception(), "type":"log", "level":"warning"})
+            else:
+                images_saved += 1
+                image_path, image_record['bytes'], image_record['hash'], phash = future.result()
+                image_record['file'] = os.path.basename(image_path)
+                job_journal.write("saved", number=number, file=image_record['file'])
+                if cache_key:
+                    try: cache.store(cache_key, image_path, image_record['hash'])
+                    except OSError: pass
+                image_id = record_image(image_record, image_path)
+                events.append({"message": f"{message} Saved as {os.path.basename(image_path)}.", "value":image_path, "type":"image", "level":None})
+                if image_id and config['DEDUPE_IMAGES']['value']: events += get_duplicate_events(number, image_id, image_path, image_record, phash, config)
+        return events
+
+    if state and state['received']:
+        # Images the provider returned before the interruption are already paid for: ones that reached the disk without being journaled are kept,
+        # and ones returned as URLs are downloaded again before anything is re-requested
+        for number, url in sorted(state['received'].items()):
+            image_path = f"{folder_path}/{number}.{transcode_format or native_format}"
+            image_record = {"number": number, "file": None, "cached": False, "request_id": None, "latency": None, "provider": None, "attempts": None}
+            if os.path.exists(image_path):
+                try: image_record.update({"file": os.path.basename(image_path), "bytes": os.path.getsize(image_path), "hash": cache.hash_file(image_path)})
+                except OSError: continue
+                images_saved += 1
+                job_journal.write("saved", number=number, file=image_record['file'])
+                record_image(image_record, image_path)
+                yield {"message": f"Kept image #{number} saved before the interruption.", "value":image_path, "type":"image", "level":None}
+                continue
+            if not url: continue
+            if transcode_format:
+                # A native file left behind mid-transcode would otherwise block the new download
+                try: os.remove(f"{folder_path}/{number}.{native_format}")
+                except OSError: pass
+            pending_saves[utils.download_pool.submit(save_image, "url", url, f"{folder_path}/{number}.{native_format}", transcode_format, png_text, config['DEDUPE_IMAGES']['value'])] = (number, f"Recovered image #{number} from before the interruption.", image_record)
+        for event in finish_saves(futures.ALL_COMPLETED): yield event
+
+    shortfall = get_image_total(job) - images_saved
+    if shortfall: job_journal.write("requested", amount=shortfall)
+    if not shortfall: results = []
+    elif job.get('template'):
+        # Read back from the journal, which by now also has the images kept or recovered above
+        skip = {number for number, file_name in journal.read_journal(folder_path)['saved'].items() if os.path.exists(f"{folder_path}/{file_name}")} if state else set()
+        results = data.generate_expansions(model['name'], get_expansion_requests(job, model, skip), shortfall, get_generation_settings(model, job, config))
+    else: results = model['generate_function'](job['prompt'], shortfall, additional_parameters, get_generation_settings(model, job, config))
+    for result in results:
+        if result['type'] == "log" or result['type'] == "error":
+            if result['type'] == "error" and result.get('index'): job_journal.write("request_failed", index=result['index'], reason=result['message'])
+            yield result
+            if result['type'] == "error" and result['level'] == "critical": break
+            continue
+
+        # An expansion's images keep the numbers it owns, everything else is numbered in the order it arrives
+        image_count = result['index'] if job.get('template') else image_count + 1
+        image_path = f"{folder_path}/{image_count}.{native_format}"
+        job_journal.write("received", number=image_count, url=result['value'] if result['type'] == "url" else None)
+        if result['type'] == "url": pool, workers = utils.download_pool, utils.DOWNLOAD_WORKERS
+        else: pool, workers = utils.save_pool, utils.SAVE_WORKERS
+        image_record = {"number": image_count, "file": None, "cached": False, "request_id": result.get('request_id'), "latency": result.get('latency'), "provider": result.get('provider'), "attempts": result.get('attempts')}
+        image_png_text = png_text
+        if job.get('template'):
+            image_record.update(prompt=result['prompt'], parameters=result['parameters'])
+            image_png_text = get_png_text(model, dict(job, prompt=result['prompt'], parameters=result['parameters']))
+        pending_saves[pool.submit(save_image, result['type'], result['value'], image_path, transcode_format, image_png_text, config['DEDUPE_IMAGES']['value'])] = (image_count, result['message'], image_record)
+        result = None
+        return_when = futures.FIRST_COMPLETED if len(pending_saves) >= workers else None
+        for event in finish_saves(return_when): yield event
+
+    for event in finish_saves(futures.ALL_COMPLETED): yield event
+    job_journal.write("finished", images_saved=images_saved)
+    # The contact sheet is prepared in the background so the view menu can show it straight away
+    if images_saved and not job.get('subfolder'): utils.save_pool.submit(thumbnails.get_contact_sheet, job['title'])
+    if cache_key: cache.evict(config['CACHE_MAX_SIZE_MB']['value'] * 1024 * 1024, config['CACHE_MAX_AGE_DAYS']['value'] * 24 * 60 * 60)
+
+    if images_saved == get_image_total(job): yield {"message": f"Saved all {images_saved} image(s)!", "value":None, "type":"log", "level":"success"}
+    else: yield {"message": f"Saved {images_saved} image(s) out of {get_image_total(job)}.", "value":None, "type":"log", "level":"warning"}
+
+def write_comparison_settings(folder_path, job):
+    models = [data.find_model(model_name)[1]['alias'] for model_name in job['models']]
+    with open(f"{folder_path}/settings.txt", 'w') as f:
+        f.write(f"Comparison Settings\n\nPrompt: {job['prompt']}\nTimestamp: {job['timestamp']}\nModels: {', '.join(models)}\nImage Amount: {job['amount']} per model\nOutput Format: {job['output_format']}")
+
+def write_comparison_metadata(folder_path, job, image_records):
+    # Shaped like a generation's settings.json so the catalog reads it the same way, plus the job itself for resuming
+    metadata = {"title": job['title'], "prompt": job['prompt'], "model": job['model'], "models": job['models'], "parameters": job['parameters'], "timestamp": job['timestamp'],
+                "amount": get_image_total(job), "output_format": job['output_format'], "job": job, "images": image_records}
+    utils.write_atomically(f"{folder_path}/settings.json", lambda file: file.write(json.dumps(metadata, indent=4).encode('utf-8')))
+
+def generate_comparison(job, config, resume=False):
+    # Every model runs at once on its own thread under its own rate limits, so a comparison takes as long as its slowest provider
+    # Each model's share is an ordinary generation (journal and all) in its subfolder, its events are passed on prefixed with the model's alias
+    folder_path = get_job_folder(job)
+    model_jobs = [dict(model_job, title=job['title']) for model_job in job['jobs']]
+    try:
+        if not resume:
+            os.makedirs(folder_path)
+            write_comparison_settings(folder_path, job)
+            write_comparison_metadata(folder_path, job, [])
+    except Exception as e:
+        yield {"message": f"Failed to create generation folder '{job['title']}'.", "value":e, "type":"error", "level":"critical"}
+        return
+    if not resume:
+        try: catalog.add_generation(dict(job, amount=get_image_total(job)))
+        except (sqlite3.Error, OSError): pass
+
+    events = queue.Queue()
+    stopped = threading.Event()
+
+    def run_model(model_job):
+        model_resume = resume and os.path.exists(journal.get_journal_path(get_job_folder(model_job)))
+        if model_resume and count_journaled_images(get_job_folder(model_job)) >= model_job['amount']:
+            events.put((model_job, None))
+            return
+        model_events = generate(model_job, config, model_resume)
+        try:
+            for event in model_events:
+                if stopped.is_set(): break
+                events.put((model_job, event))
+        except Exception as e: events.put((model_job, {"message": "Generation stopped unexpectedly.", "value":e, "type":"error", "level":"critical"}))
+        finally:
+            model_events.close()
+            events.put((model_job, None))
+
+    running = len(model_jobs)
+    for model_job in model_jobs: threading.Thread(target=run_model, args=(model_job,), name=f"ImagineSuiteCompare-{model_job['model']}", daemon=True).start()
+    try:
+        while running:
+            model_job, event = events.get()
+            if event is None:
+                running -= 1
+                continue
+            if event['type'] == "image":
+                try: append_image_record(folder_path, {"model": model_job['model'], "file": f"{model_job['subfolder']}/{os.path.basename(event['value'])}"})
+                except OSError: pass
+            yield dict(event, message=f"{data.find_model(model_job['model'])[1]['alias']}: {event['message']}")
+    finally:
+        stopped.set()
+        finish_metadata(folder_path, lambda image_records: write_comparison_metadata(folder_path, job, image_records))
+
+    images_saved = count_saved_images(job['title'])
+    if images_saved: utils.save_pool.submit(thumbnails.get_contact_sheet, job['title'])
+    if images_saved == get_image_total(job): yield {"message": f"Saved all {images_saved} image(s) across {len(model_jobs)} models!", "value":None, "type":"log", "level":"success"}
+    else: yield {"message": f"Saved {images_saved} image(s) out of {get_image_total(job)} across {len(model_jobs)} models.", "value":None, "type":"log", "level":"warning"}
@@ -0,0 +1,331 @@
+import utils, generation, cache, catalog, dedupe, jobqueue, spool, scheduler
+import os, json, time, sqlite3, dotenv, multiprocessing
+from rich.console import Console
+
+console = Console()
+SEARCH_RESULTS = 20
+
+def load_config():
+    if not os.path.exists(utils.GENERATIONS_FOLDER): os.makedirs(utils.GENERATIONS_FOLDER)
+    loaded_config, changed = utils.clean_config_file(console)
+    catalog.reconcile()
+
+    env_path = utils.DATA_FOLDER+"/.env"
+    if not os.path.exists(env_path):
+        with open(env_path, 'w') as f: pass
+    utils.clean_env_file()
+    dotenv.load_dotenv(env_path)
+    for key in utils.SERVICES.keys():
+        env_value = os.getenv(key)
+        if env_value: utils.SERVICES[key]['api_key'] = env_value
+    return loaded_config
+
+def load_manifest(manifest_path):
+    entries = []
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'): continue
+            try: entries.append((line_number, json.loads(line)))
+            except json.JSONDecodeError as e: raise ValueError(f"Line {line_number}: Invalid JSON ({e.msg}).")
+    return entries
+
+def prepare_jobs(entries, loaded_config, queue=jobqueue):
+    jobs = []
+    errors = []
+    # The queue's titles are read once up front, checking every line against the queue separately gets slow on a spool of thousands
+    titles = queue.get_taken_titles()
+    next_suffixes = {}
+    for line_number, entry in entries:
+        try: job = generation.normalise_any_job(entry, loaded_config)
+        except ValueError as e:
+            errors.append(f"Line {line_number}: {e}")
+            continue
+        priority = entry.get('priority', 0)
+        if type(priority) != int:
+            errors.append(f"Line {line_number}: Priority must be an integer.")
+            continue
+        if not entry.get('title'): job['title'] = generation.unique_title(job['title'], titles, next_suffixes)
+        elif job['title'] in titles or os.path.exists(f"{utils.GENERATIONS_FOLDER}/{job['title']}"):
+            errors.append(f"Line {line_number}: Generation folder '{job['title']}' already exists.")
+            continue
+        titles.add(job['title'])
+        jobs.append((job, priority))
+    return jobs, errors
+
+def log_event(event, prefix=""):
+    if event['type'] == "error":
+        utils.debug(f"{prefix}{event['message']} ({event['value']})", level="error", highlight=False, console=console)
+    elif event['type'] == "image":
+        utils.debug(f"{prefix}{event['message']}", level="success", highlight=False, console=console)
+    else:
+        utils.debug(f"{prefix}{event['message']}", level=event['level'], highlight=False, console=console)
+
+def run_job(job, loaded_config, resume=False, prefix="", lease_lost=None):
+    # Returns the images saved by this run and the message of the critical error that stopped it, if any
+    # Once lease_lost is set another worker owns the job, so this one stops writing to its folder straight away
+    images_saved = 0
+    critical_error = None
+    events = generation.generate(job, loaded_config, resume)
+    for event in events:
+        if event['type'] == "image": images_saved += 1
+        log_event(event, prefix)
+        if event['type'] == "error" and event['level'] == "critical": critical_error = event['message']
+        if lease_lost is not None and lease_lost.is_set():
+            events.close()
+            return images_saved, "The job was taken over by another worker."
+    return images_saved, critical_error
+
+def run_claimed_job(worker_id, claimed, loaded_config, queue=jobqueue):
+    # A job taken over from a worker whose lease expired continues from its journal rather than starting again
+    job = claimed['job']
+    saved_before = generation.count_saved_images(job['title'])
+    resume = saved_before is not None
+    if resume and saved_before >= generation.get_image_total(job):
+        queue.complete(claimed['id'], worker_id, saved_before)
+        return
+    utils.debug(f"[bold]Job {claimed['id']}:[/bold] '{job['title']}' ({job['model']}, {generation.get_image_total(job)} image(s){', resumed' if resume else ''})", console=console)
+    with jobqueue.LeaseKeeper(claimed['id'], worker_id, queue) as lease_keeper:
+        try: images_saved, critical_error = run_job(generation.load_resume_job(job['title']) if resume else job, loaded_config, resume, f"{job['title']}: ", lease_keeper.lost)
+        except Exception as e: images_saved, critical_error = 0, str(e)
+    images_saved = generation.count_saved_images(job['title']) or images_saved
+    if not critical_error and images_saved < generation.get_image_total(job): critical_error = f"Saved {images_saved} image(s) out of {generation.get_image_total(job)}."
+    queue.complete(claimed['id'], worker_id, images_saved, critical_error)
+
+def get_api_keys():
+    return {key: service['api_key'] for key, service in utils.SERVICES.items()}
+
+def work(rate_limit_share, loaded_config, api_keys, job_ids=None, spool_path=None):
+    # Worker process loop: lease the next job, run it, repeat; with job_ids it exits once those jobs have all settled
+    # With spool_path, jobs come from (and images go to) a spool directory shared with workers on other hosts
+    # The config and keys come from the parent, so workers starting together never rewrite config.json or .env under each other
+    scheduler.RATE_LIMIT_SHARE = rate_limit_share
+    queue = spool.use_spool(spool_path) if spool_path else jobqueue
+    for key, api_key in api_keys.items(): utils.SERVICES[key]['api_key'] = api_key
+    worker_id = jobqueue.get_worker_id()
+    try:
+        while True:
+            queue.heartbeat(worker_id)
+            claimed = queue.claim(worker_id)
+            if claimed:
+                # Spool workers on other hosts draw on the same accounts, so the share follows every worker the queue knows of
+                scheduler.set_rate_limit_share(min(rate_limit_share, 1 / max(1, queue.workers_active())))
+                run_claimed_job(worker_id, claimed, loaded_config, queue)
+                continue
+            if job_ids and queue.all_settled(job_ids): return
+            time.sleep(jobqueue.POLL_INTERVAL)
+    except KeyboardInterrupt: pass
+    finally:
+        queue.remove_worker(worker_id)
+        utils.shutdown_pools()
+
+def start_workers(processes, loaded_config, job_ids=None, spool_path=None):
+    # Spawned rather than forked so no worker inherits this process's database connections or pool threads
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=work, args=(1 / processes, loaded_config, get_api_keys(), job_ids, spool_path), name=f"ImagineSuiteWorker-{i+1}") for i in range(processes)]
+    for worker in workers: worker.start()
+    return workers
+
+def run_workers(processes, spool_path=None):
+    try: processes = int(processes)
+    except ValueError: processes = 0
+    if processes not in range(1, 33):
+        utils.debug("Worker processes must be a number from 1 to 32.", level="error", console=console)
+        return 2
+    if spool_path: spool.use_spool(spool_path)
+    loaded_config = load_config()
+    utils.debug(f"Started {processes} worker process(es). Press Ctrl+C to stop.", level="success", console=console)
+    workers = start_workers(processes, loaded_config, spool_path=spool_path)
+    try:
+        for worker in workers: worker.join()
+    except KeyboardInterrupt:
+        for worker in workers: worker.join()
+    return 0
+
+def enqueue_manifest(manifest_path, queue=jobqueue):
+    # Returns the ids of the queued jobs, or None if the manifest was rejected
+    loaded_config = load_config()
+    try: entries = load_manifest(manifest_path)
+    except (OSError, ValueError) as e:
+        utils.debug(f"Failed to read manifest '{manifest_path}': {e}", level="error", highlight=False, console=console)
+        return None, loaded_config
+
+    jobs, errors = prepare_jobs(entries, loaded_config, queue)
+    if errors:
+        for error in errors: utils.debug(error, level="error", highlight=False, console=console)
+        utils.debug(f"Manifest rejected with {len(errors)} invalid job(s). Nothing was generated.", level="error", console=console)
+        return None, loaded_config
+    return [queue.enqueue(job, priority) for job, priority in jobs], loaded_config
+
+def enqueue_jobs(manifest_path, queue=jobqueue):
+    job_ids, loaded_config = enqueue_manifest(manifest_path, queue)
+    if job_ids is None: return 1
+    utils.debug(f"Queued {len(job_ids)} job(s).", level="success", console=console)
+    if not queue.workers_active(): utils.debug(f"No workers are running, start some with the {'spool-worker' if queue is not jobqueue else 'worker'} command.", level="warning", console=console)
+    return 0
+
+def run_jobs(manifest_path):
+    # Queues the manifest, then runs worker processes until every one of its jobs has finished
+    job_ids, loaded_config = enqueue_manifest(manifest_path)
+    if job_ids is None: return 1
+
+    workers = start_workers(min(len(job_ids), loaded_config['WORKER_PROCESSES']['value']), loaded_config, job_ids)
+    try:
+        for worker in workers: worker.join()
+    except KeyboardInterrupt:
+        for worker in workers: worker.join()
+        utils.debug("Stopped. Unfinished jobs stay queued for the next worker.", level="warning", console=console)
+        return 1
+
+    failed_jobs = 0
+    for queued_job in jobqueue.get_jobs(job_ids):
+        amount = generation.get_image_total(json.loads(queued_job['job']))
+        if queued_job['status'] != "done":
+            failed_jobs += 1
+            utils.debug(f"Job '{queued_job['title']}' saved {queued_job['images_saved']} image(s) out of {amount}. {queued_job['error'] or ''}", level="warning", highlight=False, console=console)
+        else:
+            utils.debug(f"Job '{queued_job['title']}' saved all {queued_job['images_saved']} image(s)!", level="success", highlight=False, console=console)
+
+    if failed_jobs: utils.debug(f"Finished {len(job_ids)} job(s) with {failed_jobs} incomplete.", level="warning", console=console)
+    else: utils.debug(f"Finished all {len(job_ids)} job(s)!", level="success", console=console)
+    return 1 if failed_jobs else 0
+
+def resume_job(title, queue=jobqueue):
+    loaded_config = load_config()
+    try:
+        if queue.title_leased(title): raise ValueError(f"Generation '{title}' is being run by a worker right now.")
+        job = generation.load_resume_job(title)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        utils.debug(f"Cannot resume generation: {e}", level="error", highlight=False, console=console)
+        return 1
+    images_saved, critical_error = run_job(job, loaded_config, resume=True)
+    if critical_error:
+        utils.debug(f"Generation '{title}' stopped early, run resume again to continue it.", level="warning", highlight=False, console=console)
+        return 1
+    return 0
+
+def show_queue(queue=jobqueue):
+    load_config()
+    unfinished, finished = queue.list_jobs()
+    utils.print(f"[bold]Workers running:[/bold] {queue.workers_active()}", console=console)
+    for queued_job in unfinished + finished:
+        detail = f"leased by {queued_job['lease_owner']}" if queued_job['status'] == "leased" else f"{queued_job['images_saved']} image(s) saved" if queued_job['status'] != "queued" else f"priority {queued_job['priority']}"
+        utils.print(f"  [cyan]{queued_job['id']}[/cyan] {queued_job['status']}: '{queued_job['title']}' ({detail})", highlight=False, console=console)
+    return 0
+
+def enqueue_spool_jobs(spool_path, manifest_path):
+    return enqueue_jobs(manifest_path, spool.use_spool(spool_path))
+
+def run_spool_workers(spool_path, processes):
+    return run_workers(processes, spool_path)
+
+def show_spool_queue(spool_path):
+    return show_queue(spool.use_spool(spool_path))
+
+def resume_spool_job(spool_path, title):
+    return resume_job(title, spool.use_spool(spool_path))
+
+def show_cache_stats():
+    stats = cache.get_stats()
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = f"{stats['hits'] / lookups:.1%}" if lookups else "n/a"
+    utils.print(f"[bold]Cache:[/bold] {stats['hits']} hit(s), {stats['misses']} miss(es) ({hit_rate} hit rate), {stats['stored']} stored, {stats['evicted']} evicted", highlight=False, console=console)
+    return 0
+
+def search_generations(query):
+    load_config()
+    generations = catalog.list_generations(limit=SEARCH_RESULTS, query=query)
+    if not generations:
+        utils.print(f"No generations match '{query}'.", level="warning", highlight=False, console=console)
+        return 1
+    for generation_record in generations:
+        utils.print(f"[bold magenta]{generation_record['title']}[/bold magenta] ({generation_record['model'] or 'Unknown'}, {generation_record['image_count']} image(s), {generation_record['timestamp']})", highlight=False, console=console)
+        if generation_record['prompt']: utils.print(f"  {generation_record['prompt']}", highlight=False, console=console)
+    return 0
+
+def dedupe_generations():
+    loaded_config = load_config()
+    utils.debug(f"Computed {dedupe.backfill_perceptual_hashes()} new perceptual hash(es).", console=console)
+    utils.debug(f"Hardlinked {dedupe.collapse_all_exact()} exact duplicate image(s).", level="success", console=console)
+    groups = dedupe.find_near_duplicate_groups(loaded_config['NEAR_DUPLICATE_DISTANCE']['value'])
+    for group in groups:
+        images = [image for image in map(dedupe.get_image, group) if image]
+        utils.print(f"[bold]Near-duplicates:[/bold] {', '.join(dedupe.get_image_name(image) for image in images)}", highlight=False, console=console)
+    utils.debug(f"Found {len(groups)} group(s) of near-duplicate images.", level="success", console=console)
+    return 0
+
+COMMANDS = {
+    "run" : {
+        "arguments" : ["manifest"],
+        "description" : "Queue every job in a JSON Lines manifest of {\"model\" (or a \"models\" list to compare), \"prompt\" (or a \"template\" with \"variables\"), \"amount\", \"parameters\", \"title\", \"priority\"} records and run them in parallel worker processes.",
+        "function" : run_jobs
+    },
+    "enqueue" : {
+        "arguments" : ["manifest"],
+        "description" : "Queue every job in a manifest for running worker processes, without waiting for them.",
+        "function" : enqueue_jobs
+    },
+    "worker" : {
+        "arguments" : ["processes"],
+        "description" : "Start worker processes that run queued jobs until stopped with Ctrl+C.",
+        "function" : run_workers
+    },
+    "queue" : {
+        "arguments" : [],
+        "description" : "List queued, running and recently finished jobs.",
+        "function" : show_queue
+    },
+    "spool-enqueue" : {
+        "arguments" : ["spool", "manifest"],
+        "description" : "Queue every job in a manifest in a spool directory shared between hosts (e.g. on NFS), saving into its Generations folder.",
+        "function" : enqueue_spool_jobs
+    },
+    "spool-worker" : {
+        "arguments" : ["spool", "processes"],
+        "description" : "Start worker processes on this host that run jobs from a shared spool directory until stopped with Ctrl+C.",
+        "function" : run_spool_workers
+    },
+    "spool-queue" : {
+        "arguments" : ["spool"],
+        "description" : "List the jobs and running workers of a shared spool directory.",
+        "function" : show_spool_queue
+    },
+    "spool-resume" : {
+        "arguments" : ["spool", "title"],
+        "description" : "Continue an interrupted generation in a shared spool directory's Generations folder, unless a host is running it.",
+        "function" : resume_spool_job
+    },
+    "resume" : {
+        "arguments" : ["title"],
+        "description" : "Continue an interrupted generation, requesting only the images it is still missing.",
+        "function" : resume_job
+    },
+    "search" : {
+        "arguments" : ["query"],
+        "description" : "List the generations whose prompt, title or parameters best match the query.",
+        "function" : search_generations
+    },
+    "dedupe" : {
+        "arguments" : [],
+        "description" : "Hardlink identical images across all generations and list groups of near-duplicates.",
+        "function" : dedupe_generations
+    },
+    "cache-stats" : {
+        "arguments" : [],
+        "description" : "Show hit/miss statistics of the image cache.",
+        "function" : show_cache_stats
+    }
+}
+
+def print_usage():
+    utils.print("[bold]Usage:[/bold] app.py <command> \\[arguments]", console=console)
+    for name, command in COMMANDS.items():
+        arguments = " ".join(f"<{argument}>" for argument in command['arguments'])
+        utils.print(f"  [cyan]{name} {arguments}[/cyan] - {command['description']}", highlight=False, console=console)
+
+def main(arguments):
+    command = COMMANDS.get(arguments[0]) if arguments else None
+    if not command or len(arguments) - 1 != len(command['arguments']):
+        print_usage()
+        return 2
+    return command['function'](*arguments[1:])
@@ -0,0 +1,135 @@
+import os, errno, tempfile, struct, zlib, math
+from PIL import Image, ImageDraw
+
+# Kept free of the app's other modules so process pool workers import it cheaply
+OUTPUT_FORMATS = ["png", "jpeg", "webp"]
+PILLOW_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+LOSSY_QUALITY = 90
+THUMBNAIL_SIZE = 256
+THUMBNAIL_QUALITY = 75
+CONTACT_SHEET_CELL_SIZE = 160
+CONTACT_SHEET_MAX_COLUMNS = 10
+CONTACT_SHEET_MAX_IMAGES = 400 # 40 rows, well inside JPEG's 65500 pixel limit however large a generation gets
+CONTACT_SHEET_QUALITY = 80
+PERCEPTUAL_HASH_SIZE = 8
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_HEADER_SIZE = 33 # Signature plus the IHDR chunk, which always holds 13 bytes of data
+
+def move_into_place(temp_path, output_file_path, overwrite=True):
+    # Without overwrite an existing file is never replaced (FileExistsError instead): a hardlink only appears if nothing holds the name, atomically on NFS too
+    if overwrite: return os.replace(temp_path, output_file_path)
+    try: os.link(temp_path, output_file_path)
+    except FileExistsError: raise
+    except OSError:
+        # Filesystems without hardlinks fall back to checking first
+        if os.path.exists(output_file_path): raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), output_file_path)
+        return os.replace(temp_path, output_file_path)
+    os.remove(temp_path)
+
+def save_atomically(image, output_file_path, output_format, overwrite=True, **options):
+    folder_path, file_name = os.path.split(output_file_path)
+    file_descriptor, temp_path = tempfile.mkstemp(prefix=f".{file_name}.", suffix=".part", dir=folder_path or ".")
+    try:
+        with os.fdopen(file_descriptor, 'wb') as file: image.save(file, PILLOW_FORMATS[output_format], **options)
+        move_into_place(temp_path, output_file_path, overwrite)
+    except:
+        try: os.remove(temp_path)
+        except OSError: pass
+        raise
+
+def transcode_image(input_file_path, output_file_path, output_format):
+    with Image.open(input_file_path) as image:
+        if output_format == "jpeg" and image.mode not in ("RGB", "L"): image = image.convert("RGB")
+        if output_format == "png": save_atomically(image, output_file_path, output_format, overwrite=False, optimize=True)
+        else: save_atomically(image, output_file_path, output_format, overwrite=False, quality=LOSSY_QUALITY)
+    return output_file_path
+
+def make_thumbnail(input_file_path, output_file_path):
+    # draft() lets JPEGs decode straight at a reduced scale, reducing_gap does most of the downscale with a cheap box filter first
+    with Image.open(input_file_path) as image:
+        image.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        image = image.convert("RGB")
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS, reducing_gap=2.0)
+        save_atomically(image, output_file_path, "webp", quality=THUMBNAIL_QUALITY, method=4)
+    return output_file_path
+
+def make_contact_sheet(thumbnails, output_file_path):
+    # thumbnails is a list of (label, thumbnail path); the sheet is a numbered grid built from thumbnails only
+    thumbnails = thumbnails[:CONTACT_SHEET_MAX_IMAGES]
+    columns = max(1, min(CONTACT_SHEET_MAX_COLUMNS, math.ceil(math.sqrt(len(thumbnails)))))
+    rows = max(1, math.ceil(len(thumbnails) / columns))
+    sheet = Image.new("RGB", (columns * CONTACT_SHEET_CELL_SIZE, rows * CONTACT_SHEET_CELL_SIZE), (24, 24, 24))
+    draw = ImageDraw.Draw(sheet)
+    for i, (label, thumbnail_path) in enumerate(thumbnails):
+        left, top = i % columns * CONTACT_SHEET_CELL_SIZE, i // columns * CONTACT_SHEET_CELL_SIZE
+        try:
+            with Image.open(thumbnail_path) as thumbnail:
+                thumbnail = thumbnail.convert("RGB")
+                thumbnail.thumbnail((CONTACT_SHEET_CELL_SIZE, CONTACT_SHEET_CELL_SIZE), Image.LANCZOS)
+                sheet.paste(thumbnail, (left + (CONTACT_SHEET_CELL_SIZE - thumbnail.width) // 2, top + (CONTACT_SHEET_CELL_SIZE - thumbnail.height) // 2))
+        except OSError: pass
+        draw.rectangle((left, top, left + 8 * len(label) + 6, top + 14), fill=(0, 0, 0))
+        draw.text((left + 3, top + 2), label, fill=(255, 255, 255))
+    save_atomically(sheet, output_file_path, "jpeg", quality=CONTACT_SHEET_QUALITY, optimize=True)
+    return output_file_path
+
+def get_perceptual_hash(file_path):
+    # 64-bit difference hash: each bit compares neighbouring pixels of a tiny greyscale copy, so rescaling and recompression barely move it
+    # Returned as a signed integer so it fits an SQLite INTEGER
+    with Image.open(file_path) as image:
+        image.draft("L", (PERCEPTUAL_HASH_SIZE * 8, PERCEPTUAL_HASH_SIZE * 8))
+        pixels = image.convert("L").resize((PERCEPTUAL_HASH_SIZE + 1, PERCEPTUAL_HASH_SIZE), Image.BOX).tobytes()
+    value = 0
+    for row in range(PERCEPTUAL_HASH_SIZE):
+        for column in range(PERCEPTUAL_HASH_SIZE):
+            left = pixels[row * (PERCEPTUAL_HASH_SIZE + 1) + column]
+            value = value << 1 | (left > pixels[row * (PERCEPTUAL_HASH_SIZE + 1) + column + 1])
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def get_png_text_chunk(keyword, text):
+    # Uncompressed iTXt so prompts keep any unicode characters
+    chunk_data = keyword.encode('latin-1') + b"\x00\x00\x00\x00\x00" + text.encode('utf-8')
+    return struct.pack(">I", len(chunk_data)) + b"iTXt" + chunk_data + struct.pack(">I", zlib.crc32(b"iTXt" + chunk_data))
+
+class PngTextWriter:
+    # Passes image bytes through to file, inserting text chunks right after IHDR so the pixel data is never re-encoded
+    # Anything that doesn't start like a PNG is written through untouched
+    def __init__(self, file, text):
+        self.file = file
+        self.chunks = b"".join(get_png_text_chunk(keyword, value) for keyword, value in text.items())
+        self.header = b""
+
+    def write(self, data):
+        if self.chunks is None: return self.file.write(data)
+        self.header += data
+        if len(self.header) >= PNG_HEADER_SIZE: self.finish()
+
+    def finish(self):
+        if self.chunks is None: return
+        if self.header.startswith(PNG_SIGNATURE) and self.header[12:16] == b"IHDR":
+            self.file.write(self.header[:PNG_HEADER_SIZE] + self.chunks + self.header[PNG_HEADER_SIZE:])
+        else: self.file.write(self.header)
+        self.chunks = self.header = None
+
+def read_png_text(file_path):
+    # Reads only the chunks before the image data, so metadata costs a few hundred bytes of IO rather than a decode
+    text = {}
+    with open(file_path, 'rb') as file:
+        if file.read(8) != PNG_SIGNATURE: return text
+        while True:
+            chunk_header = file.read(8)
+            if len(chunk_header) < 8: break
+            length, chunk_type = struct.unpack(">I4s", chunk_header)
+            if chunk_type in (b"IDAT", b"IEND"): break
+            if chunk_type not in (b"tEXt", b"iTXt"):
+                file.seek(length + 4, os.SEEK_CUR)
+                continue
+            chunk_data = file.read(length)
+            file.seek(4, os.SEEK_CUR)
+            keyword, _, value = chunk_data.partition(b"\x00")
+            if chunk_type == b"iTXt":
+                if value[:1] != b"\x00": continue # Compressed iTXt isn't written by ImagineSuite
+                value = value[2:].split(b"\x00", 2)[2].decode('utf-8', 'replace')
+            else: value = value.decode('latin-1')
+            text[keyword.decode('latin-1')] = value
+    return text
@@ -0,0 +1,159 @@
+import utils
+import os, json, time, socket, sqlite3, threading
+
+QUEUE_FILE = f"{utils.DATA_FOLDER}/queue.db"
+LEASE_SECONDS = 60
+WORKER_TIMEOUT = 30
+MAX_JOB_ATTEMPTS = 3
+POLL_INTERVAL = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    job TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    images_saved INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority DESC, id);
+CREATE TABLE IF NOT EXISTS workers (
+    id TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+"""
+
+connections = threading.local()
+
+def connect():
+    # One connection per thread, same as the catalog; claims take the write lock up front so two workers never lease the same job
+    connection = getattr(connections, "connection", None)
+    if connection is None:
+        os.makedirs(utils.DATA_FOLDER, exist_ok=True)
+        connection = sqlite3.connect(QUEUE_FILE, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        connections.connection = connection
+    return connection
+
+def transaction(function):
+    def run_in_transaction(*arguments):
+        connection = connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try: result = function(connection, *arguments)
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+    return run_in_transaction
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def title_taken(title):
+    return connect().execute("SELECT 1 FROM jobs WHERE title = ? AND status IN ('queued', 'leased')", (title,)).fetchone() is not None
+
+def get_taken_titles():
+    # Every unfinished job's title at once, for checking a whole manifest against
+    return {row['title'] for row in connect().execute("SELECT title FROM jobs WHERE status IN ('queued', 'leased')")}
+
+def title_leased(title):
+    # Whether a worker is running the generation right now, resuming it alongside would put two writers in one folder
+    return connect().execute("SELECT 1 FROM jobs WHERE title = ? AND status = 'leased' AND lease_expires > ?", (title, time.time())).fetchone() is not None
+
+@transaction
+def enqueue(connection, job, priority=0):
+    now = time.time()
+    return connection.execute("INSERT INTO jobs (title, job, priority, created, updated) VALUES (?, ?, ?, ?, ?)", (job['title'], json.dumps(job), priority, now, now)).lastrowid
+
+@transaction
+def claim(connection, worker_id, job_id=None):
+    # Leases the highest priority job (or job_id), taking back jobs whose worker stopped renewing its lease
+    # Returns {"id", "job", "attempts"} or None when there is nothing to do
+    now = time.time()
+    connection.execute("UPDATE jobs SET status = 'failed', error = 'Job was interrupted too many times.', lease_owner = NULL, updated = ? WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, MAX_JOB_ATTEMPTS))
+    claimable = "(status = 'queued' OR (status = 'leased' AND lease_expires < ?))"
+    if job_id is None: row = connection.execute(f"SELECT id, job, attempts FROM jobs WHERE {claimable} ORDER BY priority DESC, id LIMIT 1", (now,)).fetchone()
+    else: row = connection.execute(f"SELECT id, job, attempts FROM jobs WHERE id = ? AND {claimable}", (job_id, now)).fetchone()
+    if not row: return None
+    connection.execute("UPDATE jobs SET status = 'leased', attempts = attempts + 1, lease_owner = ?, lease_expires = ?, updated = ? WHERE id = ?", (worker_id, now + LEASE_SECONDS, now, row['id']))
+    return {"id": row['id'], "job": json.loads(row['job']), "attempts": row['attempts'] + 1}
+
+@transaction
+def renew_lease(connection, job_id, worker_id):
+    # Returns False once the lease has been lost to another worker
+    now = time.time()
+    return connection.execute("UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? AND status = 'leased' AND lease_owner = ?", (now + LEASE_SECONDS, now, job_id, worker_id)).rowcount == 1
+
+@transaction
+def complete(connection, job_id, worker_id, images_saved, error=None):
+    connection.execute("UPDATE jobs SET status = ?, images_saved = ?, error = ?, lease_owner = NULL, lease_expires = NULL, updated = ? WHERE id = ? AND lease_owner = ?", ("failed" if error else "done", images_saved, error, time.time(), job_id, worker_id))
+
+@transaction
+def heartbeat(connection, worker_id):
+    now = time.time()
+    connection.execute("INSERT OR REPLACE INTO workers (id, heartbeat) VALUES (?, ?)", (worker_id, now))
+    connection.execute("DELETE FROM workers WHERE heartbeat < ?", (now - WORKER_TIMEOUT * 10,))
+
+@transaction
+def remove_worker(connection, worker_id):
+    connection.execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+
+def workers_active(ignored_worker_id=None):
+    return connect().execute("SELECT COUNT(*) FROM workers WHERE heartbeat > ? AND id IS NOT ?", (time.time() - WORKER_TIMEOUT, ignored_worker_id)).fetchone()[0]
+
+def get_jobs(job_ids):
+    placeholders = ", ".join("?" for job_id in job_ids)
+    return [dict(row) for row in connect().execute(f"SELECT id, title, status, attempts, images_saved, error, job FROM jobs WHERE id IN ({placeholders}) ORDER BY id", list(job_ids))]
+
+def all_settled(job_ids):
+    return all(job['status'] in ("done", "failed") for job in get_jobs(job_ids))
+
+def list_jobs(limit=20):
+    # Unfinished jobs in the order they'll run, then the most recently finished ones
+    unfinished = connect().execute("SELECT id, title, priority, status, attempts, images_saved, lease_owner FROM jobs WHERE status IN ('queued', 'leased') ORDER BY status = 'queued', priority DESC, id LIMIT ?", (limit,)).fetchall()
+    finished = connect().execute("SELECT id, title, priority, status, attempts, images_saved, lease_owner FROM jobs WHERE status IN ('done', 'failed') ORDER BY updated DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(row) for row in unfinished], [dict(row) for row in finished]
+
+class LeaseKeeper:
+    # Renews a job's lease from a background thread while the generation runs on the calling thread
+    # queue is anything with this module's heartbeat() and renew_lease() (a spool.Spool for jobs shared between hosts)
+    # lost is set once the lease has gone to another worker, or has run out without a renewal getting through
+    # Without is_worker only the lease is renewed, so a job the app runs itself never makes its window count as a worker
+    def __init__(self, job_id, worker_id, queue=None, is_worker=True):
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.heartbeat = (queue.heartbeat if queue else heartbeat) if is_worker else lambda worker_id: None
+        self.renew_lease = queue.renew_lease if queue else renew_lease
+        self.expires = time.time() + LEASE_SECONDS
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="ImagineSuiteLease", daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(LEASE_SECONDS / 3):
+            try:
+                self.heartbeat(self.worker_id)
+                renewed_at = time.time()
+                if not self.renew_lease(self.job_id, self.worker_id): break
+                self.expires = renewed_at + LEASE_SECONDS
+            except (sqlite3.Error, OSError):
+                if time.time() > self.expires: break
+        else: return
+        self.lost.set()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exception):
+        self.stopped.set()
+        self.thread.join()
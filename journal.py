@@ -0,0 +1,46 @@
+import os, json, time, threading
+
+JOURNAL_FILE_NAME = "journal.jsonl"
+
+def get_journal_path(folder_path):
+    return f"{folder_path}/{JOURNAL_FILE_NAME}"
+
+class Journal:
+    # Append-only write-ahead log of one generation, each record is fsynced before the step it describes goes ahead
+    def __init__(self, folder_path):
+        self.file = open(get_journal_path(folder_path), 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def write(self, event, **fields):
+        with self.lock:
+            self.file.write(json.dumps({"event": event, "time": time.time(), **fields}) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock: self.file.close()
+
+def read_journal(folder_path):
+    # Replays the journal into the generation's current state, a torn last line from a crash is skipped
+    # "received" holds images the provider returned that were never saved (their URL, if they came as one)
+    state = {"job": None, "requested": 0, "received": {}, "saved": {}, "failed": set(), "last_number": 0, "finished": False}
+    with open(get_journal_path(folder_path), 'r', encoding='utf-8') as f:
+        for line in f:
+            try: record = json.loads(line)
+            except ValueError: continue
+            event = record.get('event')
+            number = record.get('number')
+            if number: state['last_number'] = max(state['last_number'], number)
+            if event == "started": state['job'] = record['job']
+            elif event == "resumed": state['finished'] = False
+            elif event == "requested": state['requested'] += record['amount']
+            elif event == "received": state['received'][number] = record.get('url')
+            elif event == "saved":
+                state['received'].pop(number, None)
+                state['failed'].discard(number)
+                state['saved'][number] = record['file']
+            elif event == "failed":
+                state['received'].pop(number, None)
+                state['failed'].add(number)
+            elif event == "finished": state['finished'] = True
+    return state
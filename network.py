@@ -0,0 +1,33 @@
+import requests, threading, atexit
+from requests.adapters import HTTPAdapter
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+MAX_HOSTS = 8
+DEFAULT_POOL_SIZE = 10
+
+session = None
+session_pool_size = 0
+session_lock = threading.Lock()
+
+def get_session(pool_size=DEFAULT_POOL_SIZE):
+    # One keep-alive session per process, its per-host pool grows to match the largest concurrency asked for
+    global session, session_pool_size
+    with session_lock:
+        if session is None: session = requests.Session()
+        if pool_size > session_pool_size:
+            adapter = HTTPAdapter(pool_connections=MAX_HOSTS, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session_pool_size = pool_size
+        return session
+
+def close_session():
+    global session, session_pool_size
+    with session_lock:
+        if session is not None: session.close()
+        session = None
+        session_pool_size = 0
+
+atexit.register(close_session)
@@ -0,0 +1,97 @@
+import network
+import openai, httpx, asyncio, threading, queue, atexit
+
+loop = None
+loop_thread = None
+loop_lock = threading.Lock()
+clients = {}
+stabilityai_pool_size = 0
+retired_clients = []
+clients_lock = threading.Lock()
+MAX_PENDING_ITEMS = 4 # About utils.SAVE_WORKERS, the caller already keeps that many saves going on its own
+
+def get_loop():
+    # One event loop per process, running on a daemon thread so sync callers can hand it work between generations
+    global loop, loop_thread
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            loop_thread = threading.Thread(target=loop.run_forever, name="ImagineSuiteRuntime", daemon=True)
+            loop_thread.start()
+        return loop
+
+def run(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result()
+
+def iterate(async_iterable, max_pending=MAX_PENDING_ITEMS):
+    # Drives the async iterable on the runtime loop so requests still in flight keep progressing while the caller handles each item
+    # At most max_pending items wait for the caller; past that the iterable isn't advanced, so a scheduler behind it sends nothing new until the caller catches up
+    items = queue.Queue()
+    slots = asyncio.Semaphore(max_pending)
+
+    async def run_iterable():
+        try:
+            async for item in async_iterable:
+                await slots.acquire()
+                items.put((True, item))
+            items.put((False, None))
+        except asyncio.CancelledError: pass
+        except Exception as e: items.put((False, e))
+
+    event_loop = get_loop()
+    future = asyncio.run_coroutine_threadsafe(run_iterable(), event_loop)
+    try:
+        while True:
+            has_item, value = items.get()
+            if not has_item:
+                if value: raise value
+                return
+            event_loop.call_soon_threadsafe(slots.release)
+            yield value
+    finally:
+        if not future.done(): future.cancel()
+
+def get_openai_client(api_key):
+    with clients_lock:
+        if ("OPENAI", api_key) not in clients:
+            clients[("OPENAI", api_key)] = openai.AsyncOpenAI(api_key=api_key, max_retries=0)
+        return clients[("OPENAI", api_key)]
+
+def get_stabilityai_client(max_connections):
+    # Native async client for the StabilityAI v2beta endpoints; its pool grows to the largest in-flight limit asked for
+    # Clients it outgrows are kept open until shutdown so requests already using them can finish
+    global stabilityai_pool_size
+    with clients_lock:
+        if max_connections > stabilityai_pool_size:
+            if ("STABILITYAI", None) in clients: retired_clients.append(clients[("STABILITYAI", None)])
+            clients[("STABILITYAI", None)] = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                timeout=httpx.Timeout(network.READ_TIMEOUT, connect=network.CONNECT_TIMEOUT, pool=None)
+            )
+            stabilityai_pool_size = max_connections
+        return clients[("STABILITYAI", None)]
+
+def shutdown():
+    global loop, loop_thread, stabilityai_pool_size
+    with loop_lock:
+        if loop is None: return
+
+        async def close():
+            for client in list(clients.values()) + retired_clients:
+                if isinstance(client, httpx.AsyncClient): await client.aclose()
+                else: await client.close()
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks: task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        try: asyncio.run_coroutine_threadsafe(close(), loop).result(timeout=5)
+        except Exception: pass
+        clients.clear()
+        retired_clients.clear()
+        stabilityai_pool_size = 0
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join(timeout=5)
+        loop.close()
+        loop = loop_thread = None
+
+atexit.register(shutdown)
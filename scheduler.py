@@ -0,0 +1,333 @@
+import asyncio, time, re, random, collections, email.utils
+
+RATE_CONTROLLERS = {}
+KEY_POOLS = {}
+CIRCUIT_BREAKERS = {}
+MAX_RATE_LIMIT_RETRIES = 8
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+RATE_LIMIT_SHARE = 1 # Fraction of each model's rate limit this process may use, lowered when several worker processes share one account
+QUOTA_PARK_SECONDS = 600 # How long a key that ran out of quota sits out before it is tried again
+CIRCUIT_WINDOW = 20 # Most recent requests a model's circuit breaker judges it by
+CIRCUIT_MIN_REQUESTS = 5
+CIRCUIT_FAILURE_RATE = 0.5
+CIRCUIT_SLOW_SECONDS = 120 # A request slower than this counts as failed even when it succeeds
+CIRCUIT_OPEN_SECONDS = 30 # First cooldown of an open circuit, doubled every time a probe fails
+CIRCUIT_MAX_OPEN_SECONDS = 600
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_in):
+        super().__init__(f"Circuit open, retry in {retry_in:.0f}s.")
+        self.retry_in = retry_in
+
+class NoUsableKeyError(Exception):
+    def __init__(self):
+        super().__init__("No usable API key.")
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = max(1, per_minute)
+        self.rate = per_minute / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_wait(self, amount=1):
+        # Seconds until amount tokens are available, 0 if they already are
+        self.refill()
+        return max(0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, amount=1):
+        self.tokens -= min(amount, self.capacity)
+
+    def rescale(self, ratio):
+        self.refill()
+        self.rate *= ratio
+        self.capacity = max(1, self.rate * 60)
+        self.tokens = min(self.tokens, self.capacity)
+
+class ApiKey:
+    # One key of a service with its own per-model rate limits; a parked key sits out until parked_until, a retired one for good
+    def __init__(self, value):
+        self.value = value
+        self.rate_limiters = {}
+        self.parked_until = 0
+        self.out_of_quota = False
+        self.retired = False
+        self.last_used = 0
+
+    def get_rate_limiter(self, model):
+        if model['name'] not in self.rate_limiters:
+            limits = model.get('rate_limits') or {}
+            self.rate_limiters[model['name']] = {name: TokenBucket(value * RATE_LIMIT_SHARE) for name, value in limits.items() if value}
+        return self.rate_limiters[model['name']]
+
+    def get_wait(self, model, images=1):
+        waits = [bucket.get_wait(images if name == "images_per_minute" else 1) for name, bucket in self.get_rate_limiter(model).items()]
+        return max([0, self.parked_until - time.monotonic()] + waits)
+
+    def get_capacity(self, model):
+        # Share of its rate limit the key has left, a model without limits always counts as full
+        return min([bucket.tokens / bucket.capacity for bucket in self.get_rate_limiter(model).values()] or [1])
+
+    def take(self, model, images=1):
+        for name, bucket in self.get_rate_limiter(model).items(): bucket.take(images if name == "images_per_minute" else 1)
+        self.last_used = time.monotonic()
+
+    def park(self, delay, out_of_quota=False):
+        self.parked_until = max(self.parked_until, time.monotonic() + delay)
+        self.out_of_quota = self.out_of_quota or out_of_quota
+
+class KeyPool:
+    # Each request goes to the ready key with the most of its rate limit left (the least recently used on a tie),
+    # so N keys with their own limits give close to N times the throughput of one
+    def __init__(self, values):
+        self.values = values
+        self.keys = [ApiKey(value) for value in values]
+
+    def usable(self):
+        # Keys that may still succeed: not retired and not sitting out an exhausted quota
+        return [key for key in self.keys if not key.retired and not (key.out_of_quota and key.parked_until > time.monotonic())]
+
+    async def acquire(self, model, images=1):
+        while True:
+            waits = {key: key.get_wait(model, images) for key in self.keys if not key.retired}
+            ready = [key for key, wait in waits.items() if not wait]
+            if ready:
+                key = max(ready, key=lambda key: (key.get_capacity(model), -key.last_used))
+                key.take(model, images)
+                return key
+            # With every key retired (or none configured) nothing would ever become ready
+            if not waits: raise NoUsableKeyError()
+            await asyncio.sleep(min(waits.values()))
+
+def set_rate_limit_share(share):
+    # Rescales the buckets already made as well, so keys shared by back-to-back jobs follow the new share straight away
+    global RATE_LIMIT_SHARE
+    if share == RATE_LIMIT_SHARE: return
+    ratio = share / RATE_LIMIT_SHARE
+    RATE_LIMIT_SHARE = share
+    for key_pool in KEY_POOLS.values():
+        for key in key_pool.keys:
+            for rate_limiter in key.rate_limiters.values():
+                for bucket in rate_limiter.values(): bucket.rescale(ratio)
+
+def get_key_pool(name, values):
+    # Pools live for the whole process so back-to-back generations share the same quota, and are only rebuilt when the keys change
+    if name not in KEY_POOLS or KEY_POOLS[name].values != values: KEY_POOLS[name] = KeyPool(values)
+    return KEY_POOLS[name]
+
+def parse_duration(value):
+    # Parses provider reset durations such as "20ms", "1s" or "6m0s" into seconds
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", str(value))
+    if not parts:
+        try: return float(value)
+        except (TypeError, ValueError): return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+def get_retry_delay(headers):
+    if not headers: return None
+    headers = {key.lower(): value for key, value in headers.items()}
+    if headers.get("retry-after-ms"):
+        try: return float(headers["retry-after-ms"]) / 1000
+        except ValueError: pass
+    if headers.get("retry-after"):
+        try: return max(0, float(headers["retry-after"]))
+        except ValueError:
+            try: return max(0, email.utils.parsedate_to_datetime(headers["retry-after"]).timestamp() - time.time())
+            except (TypeError, ValueError): pass
+    delays = []
+    for key, value in headers.items():
+        if key.startswith("x-ratelimit-remaining-") and str(value).strip() == "0":
+            delay = parse_duration(headers.get(key.replace("remaining", "reset"), ""))
+            if delay is not None: delays.append(delay)
+    return max(delays) if delays else None
+
+class RateController:
+    # AIMD: every success grows the in-flight limit by roughly one per window, every 429 halves it
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.rate_limited_streak = 0
+
+    def concurrency(self):
+        return max(1, min(self.max_concurrency, int(self.limit)))
+
+    def on_success(self):
+        self.rate_limited_streak = 0
+        self.limit = min(self.max_concurrency, self.limit + 1 / max(1, self.limit))
+
+    def on_rate_limited(self, headers):
+        # Returns how long the rate limited key should sit out
+        self.rate_limited_streak += 1
+        self.limit = max(1, self.limit / 2)
+        delay = get_retry_delay(headers)
+        if delay is None: delay = min(60, 2 ** self.rate_limited_streak)
+        return delay
+
+class CircuitBreaker:
+    # Closed, requests flow and the outcome of the last CIRCUIT_WINDOW is kept; it opens once too many of them failed or were too slow
+    # Open, every request is refused until the cooldown is over; half-open, one probe goes through and its outcome closes or reopens the circuit
+    # Rate limits, key failures and rejected prompts say nothing about an outage, so they are recorded as neither
+    def __init__(self):
+        self.state = "closed"
+        self.outcomes = collections.deque(maxlen=CIRCUIT_WINDOW)
+        self.opened_at = 0
+        self.cooldown = CIRCUIT_OPEN_SECONDS
+        self.probing = False
+
+    def allow(self):
+        # Returns the state the request goes out under ("closed" or "half-open"), or None if it is refused
+        if self.state == "open" and time.monotonic() >= self.opened_at + self.cooldown: self.state = "half-open"
+        if self.state == "closed": return "closed"
+        if self.state == "half-open" and not self.probing:
+            self.probing = True
+            return "half-open"
+        return None
+
+    def get_retry_in(self):
+        return max(0, self.opened_at + self.cooldown - time.monotonic())
+
+    def open(self, cooldown):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.cooldown = min(CIRCUIT_MAX_OPEN_SECONDS, cooldown)
+
+    def record(self, sent_under, failed):
+        # failed is None for outcomes that don't count either way
+        if sent_under == "half-open":
+            self.probing = False
+            if failed: self.open(self.cooldown * 2)
+            elif failed is not None:
+                self.state = "closed"
+                self.outcomes.clear()
+                self.cooldown = CIRCUIT_OPEN_SECONDS
+            return
+        # Requests sent before the circuit opened change nothing once it has
+        if self.state != "closed" or failed is None: return
+        self.outcomes.append(failed)
+        if len(self.outcomes) >= CIRCUIT_MIN_REQUESTS and self.outcomes.count(True) >= CIRCUIT_FAILURE_RATE * len(self.outcomes): self.open(CIRCUIT_OPEN_SECONDS)
+
+def get_circuit_breaker(model):
+    # One per model for the whole process, and each model belongs to a single service, so an outage fails every job for it fast
+    if model['name'] not in CIRCUIT_BREAKERS: CIRCUIT_BREAKERS[model['name']] = CircuitBreaker()
+    return CIRCUIT_BREAKERS[model['name']]
+
+def get_rate_controller(model, max_concurrency):
+    if model['name'] not in RATE_CONTROLLERS: RATE_CONTROLLERS[model['name']] = RateController(max_concurrency)
+    rate_controller = RATE_CONTROLLERS[model['name']]
+    rate_controller.max_concurrency = max_concurrency
+    return rate_controller
+
+def observe(key, headers):
+    # Lets adapters report the x-ratelimit-* headers of successful responses so the key sits out before it gets a 429
+    delay = get_retry_delay({name: value for name, value in headers.items() if name.lower().startswith("x-ratelimit-")})
+    if delay: key.park(delay)
+
+def get_backoff_delay(retry):
+    # Exponential backoff with full jitter so retried images don't hit the provider in lockstep
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** retry))
+
+def pack_indexes(indexes, images_per_request):
+    indexes = list(indexes)
+    return [tuple(indexes[start:start+images_per_request]) for start in range(0, len(indexes), images_per_request)]
+
+def pack_requests(model, request_function, amount):
+    # Every image of one prompt, packed into as few requests as the model's "images_per_request" allows
+    return ((indexes, request_function) for indexes in pack_indexes(range(1, amount+1), model.get('images_per_request', 1)))
+
+async def schedule(model, requests, concurrency, key_pool, max_attempts=1, is_retryable=lambda e: False, get_rate_limit_headers=lambda e: None, get_key_failure=lambda e: None):
+    # Yields one {"index", "image", "error", "attempts", "latency", "request_id"} outcome per image as soon as it is settled
+    # requests yields (indexes, request_function) pairs and is only read as slots free up, so it can be a lazy stream of any length
+    # request_function(n, key) returns {"images": [n images], "request_id"}
+    # Rate limited requests are re-queued without using up an attempt and their key sits out, other retryable errors are retried with backoff
+    # get_key_failure(e) returns "invalid" to retire the key that was used or "quota" to park it, the request then moves to another key
+    # A non-retryable error (or running out of keys) stops the schedule, after the images that already finished have been yielded
+    # While the model's circuit breaker is open no request is sent, the schedule raises CircuitOpenError once nothing is in flight
+    rate_controller = get_rate_controller(model, concurrency)
+    circuit_breaker = get_circuit_breaker(model)
+    requests = iter(requests)
+
+    async def run(indexes, request_function, attempt, sent_under):
+        # Returns (key, response, error) so a failure can be put down to the key it was sent with, key is None if nothing was sent
+        if attempt > 1:
+            await asyncio.sleep(get_backoff_delay(attempt - 1))
+            # The circuit may have opened during the backoff, in which case the retry goes back to wait with the rest
+            if sent_under == "closed" and circuit_breaker.state != "closed": return None, None, None
+        key = await key_pool.acquire(model, len(indexes))
+        started = time.monotonic()
+        try: response = await request_function(len(indexes), key)
+        except Exception as e: return key, None, e
+        response['latency'] = time.monotonic() - started
+        return key, response, None
+
+    # Retries go ahead of anything not yet read from requests
+    queue = collections.deque()
+    exhausted = False
+    pending = {}
+    try:
+        while True:
+            while len(pending) < rate_controller.concurrency():
+                if queue: indexes, request_function, attempt = queue.popleft()
+                elif exhausted: break
+                else:
+                    try: indexes, request_function = next(requests)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    attempt = 1
+                sent_under = circuit_breaker.allow()
+                if not sent_under:
+                    queue.appendleft((indexes, request_function, attempt))
+                    break
+                pending[asyncio.ensure_future(run(indexes, request_function, attempt, sent_under))] = (indexes, request_function, attempt, sent_under)
+            if not pending:
+                if queue: raise CircuitOpenError(circuit_breaker.get_retry_in())
+                break
+            done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+            fatal_error = None
+            for task in done:
+                indexes, request_function, attempt, sent_under = pending.pop(task)
+                key, response, error = task.result()
+                if key is None:
+                    queue.appendleft((indexes, request_function, attempt))
+                    continue
+                if not error:
+                    circuit_breaker.record(sent_under, response['latency'] > CIRCUIT_SLOW_SECONDS)
+                    rate_controller.on_success()
+                    key.out_of_quota = False
+                    images = response['images']
+                    for index, image in zip(indexes, images):
+                        yield {"index": index, "image": image, "error": None, "attempts": attempt, "latency": response['latency'], "request_id": response.get('request_id')}
+                    if len(images) >= len(indexes): continue
+                    indexes = indexes[len(images):]
+                    error = ValueError(f"Provider returned {len(images)} image(s) instead of {len(images) + len(indexes)}.")
+                key_failure = get_key_failure(error)
+                headers = get_rate_limit_headers(error)
+                if not response: circuit_breaker.record(sent_under, True if not key_failure and headers is None and is_retryable(error) else None)
+                if key_failure:
+                    if key_failure == "invalid": key.retired = True
+                    else: key.park(QUOTA_PARK_SECONDS, out_of_quota=True)
+                    if key_pool.usable(): queue.append((indexes, request_function, attempt))
+                    else: fatal_error = fatal_error or error
+                elif headers is not None:
+                    if rate_controller.rate_limited_streak >= MAX_RATE_LIMIT_RETRIES: fatal_error = fatal_error or error
+                    else:
+                        key.park(rate_controller.on_rate_limited(headers))
+                        queue.append((indexes, request_function, attempt))
+                elif not is_retryable(error): fatal_error = fatal_error or error
+                elif attempt < max_attempts: queue.append((indexes, request_function, attempt + 1))
+                else:
+                    for index in indexes: yield {"index": index, "image": None, "error": error, "attempts": attempt, "latency": None, "request_id": None}
+            if fatal_error: raise fatal_error
+    finally:
+        # A cancelled probe settles nothing, but must hand the half-open circuit its probe back or no request is ever let through again
+        for task, (indexes, request_function, attempt, sent_under) in pending.items():
+            task.cancel()
+            circuit_breaker.record(sent_under, None)
+        await asyncio.gather(*pending, return_exceptions=True)
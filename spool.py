@@ -0,0 +1,174 @@
+import utils, catalog, thumbnails, jobqueue, templates
+import os, json, time, uuid, shutil, hashlib
+
+LEASE_GRACE = 30 # Allowance for clock differences between hosts before an unrenewed lease counts as abandoned
+
+def read_json(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f: return json.load(f)
+    except (OSError, ValueError): return None
+
+def write_json(path, value, overwrite=True):
+    utils.write_atomically(path, lambda file: file.write(json.dumps(value).encode('utf-8')), overwrite=overwrite)
+
+def remove_file(path):
+    try: os.remove(path)
+    except OSError: pass
+
+class Spool:
+    # Job queue shared by several hosts through one directory (an NFS mount, say), with the same interface as jobqueue
+    # Nothing is locked: claims rely only on creating a file that must not exist yet, which network filesystems do atomically
+    # jobs/{id}.json is a queued job, leases/{id}.{attempt}.lease its leases, done/{id}.json its outcome, csv/{id}.csv its template's CSV, workers/ the heartbeats
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.jobs_folder = f"{self.path}/jobs"
+        self.leases_folder = f"{self.path}/leases"
+        self.done_folder = f"{self.path}/done"
+        self.workers_folder = f"{self.path}/workers"
+        self.generations_folder = f"{self.path}/Generations"
+        self.csv_folder = f"{self.path}/csv"
+        for folder in (self.jobs_folder, self.leases_folder, self.done_folder, self.workers_folder, self.generations_folder, self.csv_folder):
+            os.makedirs(folder, exist_ok=True)
+        self.queued_jobs = {}
+
+    def get_lease_path(self, job_id, attempt):
+        return f"{self.leases_folder}/{job_id}.{attempt}.lease"
+
+    def get_attempts(self):
+        # The newest lease of every job: a takeover creates attempt n+1, so two workers can never both take over attempt n
+        attempts = {}
+        for file_name in os.listdir(self.leases_folder):
+            try: job_id, attempt, extension = file_name.rsplit('.', 2)
+            except ValueError: continue
+            if extension == "lease" and attempt.isdigit(): attempts[job_id] = max(attempts.get(job_id, 0), int(attempt))
+        return attempts
+
+    def get_lease(self, job_id, attempts=None):
+        attempt = (attempts if attempts is not None else self.get_attempts()).get(job_id, 0)
+        if not attempt: return None
+        lease = read_json(self.get_lease_path(job_id, attempt))
+        if lease is None: return {"owner": None, "expires": 0, "attempt": attempt}
+        return dict(lease, attempt=attempt)
+
+    def get_queued_jobs(self):
+        # A job file never changes once written, so each one is read a single time and every later poll only lists the folders
+        done = set(os.listdir(self.done_folder))
+        file_names = [file_name for file_name in os.listdir(self.jobs_folder) if file_name.endswith(".json") and file_name not in done]
+        self.queued_jobs = {file_name: self.queued_jobs.get(file_name) or read_json(f"{self.jobs_folder}/{file_name}") for file_name in file_names}
+        return sorted(filter(None, self.queued_jobs.values()), key=lambda queued_job: (-queued_job['priority'], queued_job['id']))
+
+    def title_taken(self, title):
+        return title in self.get_taken_titles()
+
+    def get_taken_titles(self):
+        return {queued_job['title'] for queued_job in self.get_queued_jobs()}
+
+    def title_leased(self, title):
+        attempts = self.get_attempts()
+        leases = [self.get_lease(queued_job['id'], attempts) for queued_job in self.get_queued_jobs() if queued_job['title'] == title]
+        return any(lease and lease['expires'] + LEASE_GRACE > time.time() for lease in leases)
+
+    def enqueue(self, job, priority=0):
+        # Ids start with the time so jobs of equal priority run in the order they were queued
+        job_id = f"{int(time.time() * 1000):012x}-{uuid.uuid4().hex[:8]}"
+        if job.get('csv'):
+            # A template's CSV may only exist on this host, so the spool keeps its own copy for whichever host runs (or resumes) the job
+            with open(job['csv'], 'rb') as source: utils.write_atomically(f"{self.csv_folder}/{job_id}.csv", lambda file: shutil.copyfileobj(source, file))
+            job = dict(job, csv=f"{job_id}.csv")
+        write_json(f"{self.jobs_folder}/{job_id}.json", {"id": job_id, "title": job['title'], "job": job, "priority": priority, "created": time.time()})
+        return job_id
+
+    def claim(self, worker_id, job_id=None):
+        # Same contract as jobqueue.claim(), losing a race for one job just moves on to the next
+        now = time.time()
+        attempts = self.get_attempts()
+        for queued_job in self.get_queued_jobs():
+            if job_id is not None and queued_job['id'] != job_id: continue
+            lease = self.get_lease(queued_job['id'], attempts)
+            if lease and lease['expires'] + LEASE_GRACE > now: continue
+            attempt = lease['attempt'] + 1 if lease else 1
+            if attempt > jobqueue.MAX_JOB_ATTEMPTS:
+                self.finish(queued_job, lease['attempt'], "failed", 0, "Job was interrupted too many times.")
+                continue
+            try: write_json(self.get_lease_path(queued_job['id'], attempt), {"owner": worker_id, "expires": now + jobqueue.LEASE_SECONDS}, overwrite=False)
+            except FileExistsError: continue
+            if os.path.exists(f"{self.done_folder}/{queued_job['id']}.json"):
+                # Finished by its last owner while this claim was being made
+                remove_file(self.get_lease_path(queued_job['id'], attempt))
+                continue
+            if lease: remove_file(self.get_lease_path(queued_job['id'], lease['attempt']))
+            return {"id": queued_job['id'], "job": queued_job['job'], "attempts": attempt}
+        return None
+
+    def renew_lease(self, job_id, worker_id):
+        # Returns False once the lease has been lost to another worker
+        lease = self.get_lease(job_id)
+        if not lease or lease['owner'] != worker_id: return False
+        write_json(self.get_lease_path(job_id, lease['attempt']), {"owner": worker_id, "expires": time.time() + jobqueue.LEASE_SECONDS})
+        return True
+
+    def finish(self, queued_job, attempts, status, images_saved, error):
+        write_json(f"{self.done_folder}/{queued_job['id']}.json", dict(queued_job, status=status, attempts=attempts, images_saved=images_saved, error=error, lease_owner=None, updated=time.time()))
+        remove_file(f"{self.jobs_folder}/{queued_job['id']}.json")
+        for file_name in os.listdir(self.leases_folder):
+            if file_name.startswith(f"{queued_job['id']}."): remove_file(f"{self.leases_folder}/{file_name}")
+
+    def complete(self, job_id, worker_id, images_saved, error=None):
+        lease = self.get_lease(job_id)
+        queued_job = read_json(f"{self.jobs_folder}/{job_id}.json")
+        if not lease or lease['owner'] != worker_id or not queued_job: return
+        self.finish(queued_job, lease['attempt'], "failed" if error else "done", images_saved, error)
+
+    def get_worker_path(self, worker_id):
+        return f"{self.workers_folder}/{worker_id.replace(':', '-')}.json"
+
+    def heartbeat(self, worker_id):
+        now = time.time()
+        write_json(self.get_worker_path(worker_id), {"id": worker_id, "heartbeat": now})
+        for file_name in os.listdir(self.workers_folder):
+            worker = read_json(f"{self.workers_folder}/{file_name}")
+            if worker and worker['heartbeat'] < now - jobqueue.WORKER_TIMEOUT * 10: remove_file(f"{self.workers_folder}/{file_name}")
+
+    def remove_worker(self, worker_id):
+        remove_file(self.get_worker_path(worker_id))
+
+    def workers_active(self, ignored_worker_id=None):
+        workers = [read_json(f"{self.workers_folder}/{file_name}") for file_name in os.listdir(self.workers_folder)]
+        return len([worker for worker in workers if worker and worker['heartbeat'] > time.time() - jobqueue.WORKER_TIMEOUT and worker['id'] != ignored_worker_id])
+
+    def get_job(self, job_id, attempts):
+        # Shaped like a row of jobqueue's jobs table, job included as JSON
+        queued_job = read_json(f"{self.done_folder}/{job_id}.json")
+        if not queued_job:
+            queued_job = read_json(f"{self.jobs_folder}/{job_id}.json")
+            if not queued_job: return None
+            lease = self.get_lease(job_id, attempts)
+            leased = lease and lease['expires'] + LEASE_GRACE > time.time()
+            queued_job.update(status="leased" if leased else "queued", attempts=attempts.get(job_id, 0), images_saved=0, error=None, lease_owner=lease['owner'] if leased else None)
+        return dict(queued_job, job=json.dumps(queued_job['job']))
+
+    def get_jobs(self, job_ids):
+        attempts = self.get_attempts()
+        return list(filter(None, (self.get_job(job_id, attempts) for job_id in sorted(job_ids))))
+
+    def all_settled(self, job_ids):
+        return all(os.path.exists(f"{self.done_folder}/{job_id}.json") for job_id in job_ids)
+
+    def list_jobs(self, limit=20):
+        # Unfinished jobs in the order they'll run, then the most recently finished ones
+        unfinished = self.get_jobs([queued_job['id'] for queued_job in self.get_queued_jobs()])
+        unfinished.sort(key=lambda queued_job: (queued_job['status'] == "queued", -queued_job['priority'], queued_job['id']))
+        finished = [read_json(f"{self.done_folder}/{file_name}") for file_name in os.listdir(self.done_folder) if file_name.endswith(".json")]
+        finished = sorted(filter(None, finished), key=lambda queued_job: -queued_job['updated'])
+        return unfinished[:limit], finished[:limit]
+
+def use_spool(path):
+    # Points this process at the spool's shared generations folder, indexed by a catalog of its own on this host since SQLite doesn't belong on a network share
+    shared_spool = Spool(path)
+    state_folder = f"{utils.DATA_FOLDER}/Spools/{hashlib.sha256(shared_spool.path.encode('utf-8')).hexdigest()[:16]}"
+    os.makedirs(state_folder, exist_ok=True)
+    utils.GENERATIONS_FOLDER = shared_spool.generations_folder
+    catalog.CATALOG_FILE = f"{state_folder}/catalog.db"
+    thumbnails.SHEET_FOLDER = f"{state_folder}/Sheets"
+    templates.CSV_FOLDER = shared_spool.csv_folder
+    return shared_spool
@@ -0,0 +1,74 @@
+import csv, os, string, itertools
+
+EXPANSION_MODES = ["cartesian", "zip"]
+MISSING = object()
+CSV_FOLDER = None # Set by spool.use_spool, where a job's CSV is copied into the spool and only its file name is kept so every host finds it
+
+def get_fields(template):
+    # The named placeholders of a template, positional or computed ones such as {}, {0} or {a.b} are rejected
+    fields = set()
+    for literal, field, format_spec, conversion in string.Formatter().parse(template):
+        if field is None: continue
+        if not field.isidentifier(): raise ValueError(f"Template placeholder '{{{field}}}' must be a plain name.")
+        fields.add(field)
+    return fields
+
+def get_csv_path(csv_path):
+    # Absolute paths (every job outside a spool) are left as they are
+    return os.path.join(CSV_FOLDER, csv_path) if CSV_FOLDER else csv_path
+
+def read_csv_header(csv_path):
+    with open(get_csv_path(csv_path), 'r', newline='', encoding='utf-8-sig') as f: return next(csv.reader(f), [])
+
+def read_csv_rows(csv_path):
+    # One row at a time, so a CSV of any length is never held in memory
+    with open(get_csv_path(csv_path), 'r', newline='', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f): yield row
+
+def get_variable_names(job):
+    return set(job['variables']) | set(read_csv_header(job['csv']) if job.get('csv') else [])
+
+def get_parameter_variable_names(job):
+    # Names the template uses as placeholders only ever fill them, even when a model parameter shares the name
+    return get_variable_names(job) - get_fields(job['template'])
+
+def zip_strictly(sources):
+    for values in itertools.zip_longest(*sources, fillvalue=MISSING):
+        if any(value is MISSING for value in values): raise ValueError("Zipped variables and CSV rows must all have the same number of values.")
+        yield values
+
+def iterate_values(job):
+    # Yields one {variable: value} dict per combination; CSV rows are read as they're needed and each row is already a combination of its columns
+    value_lists = [[{name: value} for value in values] for name, values in job['variables'].items()]
+    rows = read_csv_rows(job['csv']) if job.get('csv') else [{}]
+    if job['expand'] == "zip": combinations = zip_strictly(([rows] if job.get('csv') else []) + value_lists)
+    else: combinations = ((row,) + combination for row in rows for combination in itertools.product(*value_lists))
+    for combination in combinations: yield {name: value for values in combination for name, value in values.items()}
+
+def get_expansion_key(prompt, parameters):
+    # Whitespace is normalised like the cache does; only the 64-bit hash is kept, which holds a million expansions in tens of megabytes
+    return hash((" ".join(prompt.split()),) + tuple(sorted(parameters.items())))
+
+def expand(job, model):
+    # Yields (prompt, parameters) for every combination in order, lazily, skipping any that repeats an earlier one
+    # Variables named after one of the model's additional parameters, and not used as a placeholder, set that parameter instead
+    fields = get_fields(job['template'])
+    parameter_options = {parameter['name']: parameter['options'] for parameter in model['additional_parameters'] or [] if parameter['name'] not in fields}
+    seen = set()
+    for number, values in enumerate(iterate_values(job), 1):
+        if None in values.values(): raise ValueError(f"Expansion {number}: CSV row is missing values.")
+        prompt = job['template'].format_map(values).strip()
+        if len(prompt) < 3 or len(prompt) > 5000: raise ValueError(f"Expansion {number}: Prompt must have a length of 3-5000 characters.")
+        parameters = dict(job['parameters'])
+        for name, options in parameter_options.items():
+            if name not in values: continue
+            if values[name] not in options: raise ValueError(f"Expansion {number}: Invalid option '{values[name]}' for parameter '{name}' (options: {', '.join(options)}).")
+            parameters[name] = values[name]
+        expansion_key = get_expansion_key(prompt, parameters)
+        if expansion_key in seen: continue
+        seen.add(expansion_key)
+        yield prompt, parameters
+
+def count_expansions(job, model):
+    # A full pass, so every expansion is checked before anything is queued
+    return sum(1 for expansion in expand(job, model))
@@ -0,0 +1,49 @@
+import utils, catalog, imaging
+import os, hashlib
+
+THUMBNAIL_FOLDER = f"{utils.DATA_FOLDER}/Thumbnails"
+SHEET_FOLDER = f"{THUMBNAIL_FOLDER}/Sheets"
+
+def get_thumbnail_path(file_hash):
+    # Keyed by content hash (and size), so a changed image simply maps to a new thumbnail
+    return f"{THUMBNAIL_FOLDER}/{file_hash[:2]}/{file_hash}-{imaging.THUMBNAIL_SIZE}.webp"
+
+def submit_thumbnail(image_path, file_hash):
+    # Called as images are saved, the returned future can be ignored
+    thumbnail_path = get_thumbnail_path(file_hash)
+    if os.path.exists(thumbnail_path): return None
+    os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+    return utils.get_transcode_pool().submit(imaging.make_thumbnail, image_path, thumbnail_path)
+
+def get_images(title):
+    # Only the first imaging.CONTACT_SHEET_MAX_IMAGES, a sheet of every image of a large template generation couldn't be saved (or even held in memory)
+    generation_record = catalog.get_generation(title)
+    if not generation_record: return None, []
+    images = catalog.connect().execute("SELECT file_name, hash FROM images WHERE generation_id = ? AND hash IS NOT NULL ORDER BY CAST(file_name AS INTEGER), file_name LIMIT ?", (generation_record['id'], imaging.CONTACT_SHEET_MAX_IMAGES)).fetchall()
+    return generation_record, [dict(image) for image in images]
+
+def get_sheet_path(generation_record, images):
+    sheet_key = hashlib.sha256("|".join(f"{image['file_name']}:{image['hash']}" for image in images).encode('utf-8')).hexdigest()[:16]
+    return f"{SHEET_FOLDER}/{generation_record['id']}-{sheet_key}.jpg"
+
+def get_contact_sheet(title):
+    # Builds whatever thumbnails are missing in parallel (the lazy backfill for older generations), then the sheet itself
+    # Returns the sheet's path, or None if the generation has no images
+    catalog.reconcile_folder(title)
+    generation_record, images = get_images(title)
+    if not images: return None
+    sheet_path = get_sheet_path(generation_record, images)
+    if os.path.exists(sheet_path): return sheet_path
+
+    pending = [submit_thumbnail(f"{catalog.get_folder_path(title)}/{image['file_name']}", image['hash']) for image in images]
+    for future in filter(None, pending):
+        try: future.result()
+        except Exception: pass
+
+    os.makedirs(SHEET_FOLDER, exist_ok=True)
+    for stale_sheet in os.listdir(SHEET_FOLDER):
+        if stale_sheet.startswith(f"{generation_record['id']}-"):
+            try: os.remove(f"{SHEET_FOLDER}/{stale_sheet}")
+            except OSError: pass
+    sheet = [(os.path.splitext(image['file_name'])[0], get_thumbnail_path(image['hash'])) for image in images]
+    return utils.get_transcode_pool().submit(imaging.make_contact_sheet, sheet, sheet_path).result()
@@ -1,5 +1,6 @@
-import data
-import sys, os, time, requests, json, base64, tempfile
+import data, network, imaging
+import sys, os, time, requests, json, base64, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from downloader import download
 from rich.console import Console
 from rich.panel import Panel
@@ -14,23 +15,55 @@ VERSION = "v1.1.0"
 RELEASE_LINK = "https://github.com/TheNebulo/ImagineSuite/releases/latest"
 FILE_NAME = "ImagineSuite.exe"
 DEFAULT_CONFIG = {
-    "BATCH_SIZE" : {
-        "value" : 3,
+    "MAX_CONCURRENCY" : {
+        "value" : 5,
+        "min_value" : 1,
+        "max_value" : 500,
+        "description" : "Maximum amount of image requests kept in flight at once (each model's rate limit still applies)."
+    },
+    "MAX_ATTEMPTS" : {
+        "value" : 4,
         "min_value" : 1,
         "max_value" : 10,
-        "description" : "Amount of images to render in one batch."
+        "description" : "Maximum attempts per image (including retries with backoff) before it is reported as failed."
     },
     "MAX_IMAGES" : {
         "value" : 30,
         "min_value" : 1,
         "max_value" : 100,
-        "description" : "Maximum amount of images to render in one request (total between batches)."
+        "description" : "Maximum amount of images to render in one request."
+    },
+    "USE_CACHE" : {
+        "value" : False,
+        "description" : "Whether to reuse cached images for repeated prompts with the same model and parameters."
+    },
+    "CACHE_MAX_SIZE_MB" : {
+        "value" : 2048,
+        "min_value" : 1,
+        "max_value" : 1048576,
+        "description" : "Maximum size (in megabytes) of the image cache before least recently used images are evicted."
+    },
+    "CACHE_MAX_AGE_DAYS" : {
+        "value" : 30,
+        "min_value" : 1,
+        "max_value" : 3650,
+        "description" : "Maximum age (in days since last use) of a cached image."
     },
-    "BATCH_TIMEOUT" : {
-        "value" : 45,
-        "min_value" : 5,
-        "max_value" : 120,
-        "description" : "Timeout (in seconds) between batches to avoid rate limits."   
+    "WORKER_PROCESSES" : {
+        "value" : 2,
+        "min_value" : 1,
+        "max_value" : 32,
+        "description" : "Amount of worker processes running queued generations side by side (they split each model's rate limit)."
+    },
+    "DEDUPE_IMAGES" : {
+        "value" : True,
+        "description" : "Whether to hardlink saved images identical to an existing one (saving disk space) and report near-duplicates."
+    },
+    "NEAR_DUPLICATE_DISTANCE" : {
+        "value" : 4,
+        "min_value" : 0,
+        "max_value" : 8,
+        "description" : "Maximum amount of differing perceptual hash bits (out of 64) for two images to count as near-duplicates."
     },
     "ALWAYS_VERIFY_KEYS" : {
         "value" : False,
@@ -47,24 +80,85 @@ EMOJIS = {
 }
 
 SERVICES = data.SERVICES
+BASE64_CHUNK_SIZE = 1 << 20 # Must stay a multiple of 4 so every chunk decodes on its own
+SAVE_WORKERS = 4
+save_pool = ThreadPoolExecutor(max_workers=SAVE_WORKERS, thread_name_prefix="ImagineSuiteSave")
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_WORKERS = 8
+download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="ImagineSuiteDownload")
+transcode_pool = None
+transcode_pool_lock = threading.Lock()
 
 last_known_online = True
 
 def valid_generation_image(file_name):
-    if file_name.endswith(".png") or file_name.endswith(".jpeg") or file_name.endswith(".jpg"): return True
+    if file_name.endswith(".png") or file_name.endswith(".jpeg") or file_name.endswith(".jpg") or file_name.endswith(".webp"): return True
     return False
 
-def base64_json_to_image(base64_json_str, output_file_path):
-    image_data = base64.b64decode(base64_json_str)
-
-    with open(output_file_path, 'wb') as file:
-        file.write(image_data)
+def write_atomically(output_file_path, write, png_text=None, overwrite=True):
+    # Writes through a hidden temp file in the same folder and renames it into place, so a half-written image never shows up
+    # Images are written with overwrite off, so a saved image is never replaced by another worker's late copy
+    folder_path, file_name = os.path.split(output_file_path)
+    file_descriptor, temp_path = tempfile.mkstemp(prefix=f".{file_name}.", suffix=".part", dir=folder_path or ".")
+    try:
+        with os.fdopen(file_descriptor, 'wb') as file:
+            if png_text:
+                writer = imaging.PngTextWriter(file, png_text)
+                write(writer)
+                writer.finish()
+            else: write(file)
+        imaging.move_into_place(temp_path, output_file_path, overwrite)
+    except:
+        try: os.remove(temp_path)
+        except OSError: pass
+        raise
+
+def base64_json_to_image(base64_json_str, output_file_path, png_text=None):
+    def write(file):
+        for start in range(0, len(base64_json_str), BASE64_CHUNK_SIZE):
+            file.write(base64.b64decode(base64_json_str[start:start+BASE64_CHUNK_SIZE]))
+    write_atomically(output_file_path, write, png_text, overwrite=False)
         
-def url_to_image(image_url, output_file_path):
-    image_data = requests.get(image_url).content
-    
-    with open(output_file_path, 'wb') as file:
-        file.write(image_data)
+def url_to_image(image_url, output_file_path, png_text=None):
+    with network.get_session(DOWNLOAD_WORKERS).get(image_url, stream=True, timeout=network.TIMEOUT) as response:
+        response.raise_for_status()
+        # Content-Length counts the encoded body while iter_content yields it decoded, so only unencoded downloads can be checked
+        expected_size = None if response.headers.get('content-encoding', 'identity').lower() != 'identity' else response.headers.get('content-length')
+
+        def write(file):
+            size = 0
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+                size += len(chunk)
+            if expected_size is not None and size != int(expected_size):
+                raise IOError(f"Downloaded {size} byte(s) but expected {expected_size}.")
+        write_atomically(output_file_path, write, png_text, overwrite=False)
+
+def get_transcode_pool():
+    # Comparisons save from one thread per model, without the lock two of them could each start a pool
+    global transcode_pool
+    with transcode_pool_lock:
+        if transcode_pool is None: transcode_pool = ProcessPoolExecutor()
+        return transcode_pool
+
+def shutdown_pools():
+    # Needed before a multiprocessing child returns: it joins its own child processes before the executors' exit hooks would stop them
+    save_pool.shutdown(wait=True)
+    download_pool.shutdown(wait=True)
+    if transcode_pool is not None: transcode_pool.shutdown(wait=True)
+
+def save_image(image_type, image, output_file_path, transcode_format=None, png_text=None):
+    # Returns the final path, which differs from output_file_path when the image is transcoded after saving
+    # png_text ({keyword: text}) is embedded into PNGs as they are written, other formats are saved without it
+    if image_type == "b64_json": base64_json_to_image(image, output_file_path, png_text)
+    elif image_type == "url": url_to_image(image, output_file_path, png_text)
+    else: raise ValueError(f"Unknown image type '{image_type}'.")
+    if not transcode_format: return output_file_path
+
+    transcoded_file_path = f"{os.path.splitext(output_file_path)[0]}.{transcode_format}"
+    get_transcode_pool().submit(imaging.transcode_image, output_file_path, transcoded_file_path, transcode_format).result()
+    if transcoded_file_path != output_file_path: os.remove(output_file_path)
+    return transcoded_file_path
 
 def flush_input_buffer():
     try:
@@ -217,6 +311,14 @@ def get_user_name():
         display_name = (entry[4] for entry in pwd.getpwall() if entry[2] == os.geteuid()).next()
         return display_name if display_name != "" else "User"
 
+def write_text_if_changed(file_path, text):
+    # Other processes may be reading the file, so it's replaced whole through a temp file and left alone when nothing changed
+    try:
+        with open(file_path, 'r') as f:
+            if f.read() == text: return
+    except OSError: pass
+    write_atomically(file_path, lambda file: file.write(text.encode('utf-8')))
+
 def clean_env_file():
     env_path = DATA_FOLDER+"/.env"
     
@@ -240,10 +342,7 @@ def clean_env_file():
             if key and value and key in SERVICES.keys():
                 env_dict[key] = value
 
-    with open(env_path, 'w') as file:
-        for key, value in env_dict.items():
-            if value:
-                file.write(f'{key}={value}\n')
+    write_text_if_changed(env_path, "".join(f'{key}={value}\n' for key, value in env_dict.items() if value))
 
 
     
@@ -267,9 +366,7 @@ def edit_or_add_env_value(key_to_edit, new_value):
     else:
         env_dict[key_to_edit] = new_value
 
-    with open(env_path, 'w') as file:
-        for key, value in env_dict.items():
-            file.write(f'{key}={value}\n')
+    write_text_if_changed(env_path, "".join(f'{key}={value}\n' for key, value in env_dict.items()))
             
 def clean_config_file(console, verbose = False):
     config_path = f"{DATA_FOLDER}/config.json"
@@ -283,14 +380,14 @@ def clean_config_file(console, verbose = False):
                 debug("Config file corrupted! Restoring to default.", level="error", console=console)
                 time.sleep(1)
             changed = True
-            with open(config_path, 'w') as f: json.dump(DEFAULT_CONFIG, f)
+            write_text_if_changed(config_path, json.dumps(DEFAULT_CONFIG))
             loaded_config = DEFAULT_CONFIG
     else:
         if verbose:
             debug("Missing config file. Creating new config file.", level="warning", console=console)
             time.sleep(1)
         changed = True
-        with open(config_path, 'w') as f: json.dump(DEFAULT_CONFIG, f)
+        write_text_if_changed(config_path, json.dumps(DEFAULT_CONFIG))
         loaded_config = DEFAULT_CONFIG 
             
     if type(loaded_config) == dict:
@@ -361,13 +458,13 @@ def clean_config_file(console, verbose = False):
             debug("Config file corrupted! Restoring to default.", level="error", console=console)
             time.sleep(1)
         changed = True
-        with open(config_path, 'w') as f: json.dump(DEFAULT_CONFIG, f)
+        write_text_if_changed(config_path, json.dumps(DEFAULT_CONFIG))
         loaded_config = DEFAULT_CONFIG
     
     modified_config = {}
     for key in loaded_config.keys():
         if key in DEFAULT_CONFIG.keys(): modified_config[key] = loaded_config[key]
     loaded_config = modified_config
-    with open(config_path, 'w') as f: json.dump(loaded_config, f)
-    time.sleep(1)
+    write_text_if_changed(config_path, json.dumps(loaded_config))
+    if verbose: time.sleep(1)
     return loaded_config, changed
\ No newline at end of file